@@ -6,9 +6,20 @@ import os
 import sys
 import errno
 import os.path
+import fnmatch
+import calendar
+import itertools
+import threading
 
 from fuse import FUSE, FuseOSError, Operations
 from time import time
+from cache import AttrCache, BlobAttrs, ChunkCache, ContainerIndex, NegativeCache, OpenedVersions
+from service import ServicePool
+from diskcache import DiskCache
+from download import AdaptiveParallelism, RangeCoalescer, SingleFlight, fetch_parallel
+from readahead import Prefetcher, ReadAhead
+from upload import AppendWriter, BlockWriter, PageWriter, UploadPool, UploadStats
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
 from azure.storage import CloudStorageAccount
 from tests import (
 	BlobSasSamples,
@@ -20,12 +31,40 @@ from tests import (
 
 from azure.storage.blob import BlockBlobService
 from azure.storage.blob import baseblobservice
+from azure.storage.blob.models import BlobPrefix
 import azure.storage.blob
 
 import pdb
 
 debug = True 
 
+# Extended attributes on the mount root that report cache statistics,
+# e.g. getfattr -n user.blobfs.attr_hits mnt
+STATS_XATTR_PREFIX = 'user.blobfs.'
+
+DIRENTS = ['.', '..']
+
+# os.O_ACCMODE only exists on Python 3
+O_ACCMODE = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+
+class OpenFile(object):
+	"""
+	State kept for an open file handle.
+
+	writer is the BlockWriter of handles opened for writing and None for
+	handles opened for reading only.
+	"""
+
+	def __init__(self, path, readahead=None, writer=None):
+		self.path = path
+		self.readahead = readahead
+		self.writer = writer
+
+def _timestamp(value):
+	if value is None:
+		return time()
+	return calendar.timegm(value.utctimetuple())
+
 class Passthrough(Operations):
 	def __init__(self, root):
 		self.root = root
@@ -36,24 +75,429 @@ class Passthrough(Operations):
 			raise ValueError('Please specify configuration settings in config.py.')
 
 		if config.IS_EMULATED:
-			self.account = CloudStorageAccount(is_emulated=True)
+			credentials = dict(is_emulated=True)
 		else:
 			# Note that account key and sas should not both be included
-			account_name = config.STORAGE_ACCOUNT_NAME
-			account_key = config.STORAGE_ACCOUNT_KEY
-			sas = config.SAS
-			self.account = CloudStorageAccount(account_name=account_name, 
-											   account_key=account_key, 
-											   sas_token=sas)
-			self.service = self.account.create_block_blob_service()
+			credentials = dict(account_name=config.STORAGE_ACCOUNT_NAME,
+							   account_key=config.STORAGE_ACCOUNT_KEY,
+							   sas_token=config.SAS or None)
+		self.services = ServicePool(
+			pool_size=getattr(config, 'CONNECTION_POOL_SIZE', 16), **credentials)
+
+		self.attr_cache = AttrCache(
+			ttl=getattr(config, 'ATTR_CACHE_TTL', 5),
+			max_entries=getattr(config, 'ATTR_CACHE_SIZE', 10000))
+		self.negative_cache = NegativeCache(
+			ttl=getattr(config, 'NEGATIVE_CACHE_TTL', 2),
+			max_entries=getattr(config, 'NEGATIVE_CACHE_SIZE', 10000))
+		self.chunk_size = getattr(config, 'READ_CHUNK_SIZE', 4 * 1024 * 1024)
+		self.chunk_cache = ChunkCache(getattr(config, 'READ_CACHE_BYTES', 256 * 1024 * 1024))
+		disk_cache_bytes = getattr(config, 'DISK_CACHE_BYTES', 10 * 1024 ** 3)
+		self.disk_cache = None
+		if disk_cache_bytes:
+			# containers cannot start with a '.', so this never shadows one
+			self.disk_cache = DiskCache(os.path.join(root, '.blobfs-cache'),
+										disk_cache_bytes, self.chunk_size)
+		self.readahead_chunks = getattr(config, 'READAHEAD_CHUNKS', 8)
+		self.readahead_streams = getattr(config, 'READAHEAD_STREAMS', 4)
+		self.readahead_min_accuracy = getattr(config, 'READAHEAD_MIN_ACCURACY', 0.25)
+		self.readahead_totals = dict.fromkeys(['seeks', 'strides', 'predicted_chunks',
+											   'useful_chunks', 'disabled_handles'], 0)
+		self.prefetcher = Prefetcher(workers=getattr(config, 'PREFETCH_WORKERS', 4))
+		self.parallel_min_bytes = getattr(config, 'PARALLEL_DOWNLOAD_MIN_BYTES', 64 * 1024 * 1024)
+		self.parallel_range_bytes = getattr(config, 'PARALLEL_RANGE_BYTES', 1024 * 1024)
+		# a chunk never splits into more ranges than fit in it
+		self.parallelism = AdaptiveParallelism(
+			max_degree=min(getattr(config, 'MAX_PARALLEL_RANGES', 8),
+						   max(1, self.chunk_size // self.parallel_range_bytes)))
+		self.flights = SingleFlight()
+		self.coalescer = None
+		coalesce_window = getattr(config, 'READ_COALESCE_WINDOW', 0)
+		if coalesce_window:
+			self.coalescer = RangeCoalescer(
+				lambda key, start, end: self._get_range(*(key + (start, end))),
+				coalesce_window,
+				max_gap=getattr(config, 'READ_COALESCE_GAP', 64 * 1024),
+				max_bytes=getattr(config, 'READ_COALESCE_MAX_BYTES', 16 * 1024 * 1024))
+		self.small_file_bytes = getattr(config, 'SMALL_FILE_BYTES', 1024 * 1024)
+		self.small_file_overrides = getattr(config, 'SMALL_FILE_BYTES_BY_CONTAINER', {})
+		self.hint_patterns = getattr(config, 'PREFETCH_HINT_PATTERNS', [])
+		self.hint_footer_bytes = getattr(config, 'PREFETCH_FOOTER_BYTES', 1024 * 1024)
+		self.hint_header_bytes = getattr(config, 'PREFETCH_HEADER_BYTES', 0)
+		self.hinted = 0
+		self.preloaded = 0
+		self.revalidated = 0
+		self.zero_copy_reads = 0
+		self.copied_reads = 0
+		self.zero_copy_writes = 0
+		self.copied_writes = 0
+		if not getattr(config, 'ZERO_COPY_READS', True):
+			# FUSE falls back to read, e.g. to compare the CPU cost of both
+			self.read_into = None
+		if not getattr(config, 'ZERO_COPY_WRITES', True):
+			self.write_from = None
+		self.changed = 0
+		self.opened_versions = OpenedVersions(getattr(config, 'ATTR_CACHE_SIZE', 10000))
+		self.direct_io_patterns = getattr(config, 'DIRECT_IO_PATTERNS', [])
+		self.kept_page_cache = 0
+		self.direct_io_opens = 0
+		self.upload_block_bytes = getattr(config, 'UPLOAD_BLOCK_BYTES', 4 * 1024 * 1024)
+		self.upload_stats = UploadStats()
+		self.upload_pool = UploadPool(
+			workers=getattr(config, 'UPLOAD_WORKERS', 8),
+			max_bytes=getattr(config, 'UPLOAD_MAX_IN_FLIGHT_BYTES', 64 * 1024 * 1024))
+		self.append_blob_patterns = getattr(config, 'APPEND_BLOB_PATTERNS', [])
+		self.page_blob_patterns = getattr(config, 'PAGE_BLOB_PATTERNS', [])
+		self.page_blob_containers = getattr(config, 'PAGE_BLOB_CONTAINERS', [])
+		self.writers = {}
+		self.handles = {}
+		# with FUSE_THREADS, opens, creates and releases of the same blob
+		# race; making or finding its writer, attaching a handle to it and
+		# dropping it when the last handle goes all happen under this lock
+		self._writers_lock = threading.Lock()
+		self._file_handles = itertools.count(1)
+		self.readdir_page_size = getattr(config, 'READDIR_PAGE_SIZE', 1000)
+		self.dir_pages = {}
+		self._dir_handles = itertools.count(1)
+		self.containers = ContainerIndex(
+			lambda: (container.name for container in self.service.list_containers()),
+			interval=getattr(config, 'CONTAINER_REFRESH_INTERVAL', 30))
 
 
+	@property
+	def service(self):
+		return self.services.block
+
 	def _full_path(self, partial):
 		if partial.startswith("/"):
 			partial = partial[1:]
 		path = os.path.join(self.root, partial)
 		return path
 
+	def _split_path(self, path):
+		"""
+		Maps a mount path to (container, blob name). Everything below the
+		container is a blob name, so /container/a/b/c refers to blob 'a/b/c'
+		and the intermediate components are virtual directories.
+		"""
+		parts = path[1:].split('/', 1)
+		containername = parts[0]
+		filename = parts[1] if len(parts) > 1 and parts[1] else None
+		return containername, filename
+
+	def _lookup(self, containername, filename):
+		"""
+		Returns the BlobAttrs of a blob, from the attribute cache when the
+		entry is still fresh and from get_blob_properties otherwise.
+
+		When no blob has that name but other blobs are named below it, the
+		name is a virtual directory and the returned attrs have is_dir set.
+
+		Raises ENOENT for blobs that do not exist; recent misses are answered
+		from the negative cache without a request.
+		"""
+		key = (containername, filename)
+		attrs = self.attr_cache.get(key)
+		if attrs is None:
+			if key in self.negative_cache:
+				raise FuseOSError(errno.ENOENT)
+			stored = None
+			if self.disk_cache is not None:
+				stored = self.disk_cache.stored(containername, filename)
+			try:
+				if stored is not None:
+					return self._revalidate(containername, filename, stored)
+				properties = self.service.get_blob_properties(containername, filename).properties
+				return self._cache_properties(containername, filename, properties)
+			except AzureMissingResourceHttpError:
+				self._drop_data(containername, filename)
+			try:
+				children = self.service.list_blobs(containername, prefix=filename + '/',
+												   num_results=1)
+			except AzureMissingResourceHttpError:
+				children = []
+			# a listing is a generator that is never falsy; test the first item
+			if next(iter(children), None) is None:
+				self.negative_cache.add(key)
+				raise FuseOSError(errno.ENOENT)
+			attrs = self.attr_cache.put_directory(key)
+		return attrs
+
+	def _revalidate(self, containername, filename, stored):
+		"""
+		Checks data cached on disk with a conditional get_blob_properties
+		against its etag. An unchanged blob answers 304, and its attributes
+		are taken from the cache entry without moving any data.
+		"""
+		try:
+			properties = self.service.get_blob_properties(containername, filename,
+														  if_none_match=stored.etag).properties
+		except AzureHttpError as e:
+			if e.status_code != 304:
+				raise
+			self.revalidated += 1
+			return self.attr_cache.put((containername, filename), stored.size,
+									   stored.last_modified or time(), stored.etag)
+		return self._cache_properties(containername, filename, properties)
+
+	def _cache_properties(self, containername, filename, properties):
+		"""
+		Caches properties from get_blob_properties or a listing. Data held
+		for a different etag belongs to an older version of the blob and is
+		dropped; for a listing this revalidates a whole directory at once.
+		"""
+		key = (containername, filename)
+		previous = self.attr_cache.peek(key)
+		stored = None
+		if self.disk_cache is not None:
+			stored = self.disk_cache.stored(containername, filename)
+		if any(cached is not None and cached.etag != properties.etag
+			   for cached in (previous, stored)):
+			self.changed += 1
+			self._drop_data(containername, filename)
+		return self.attr_cache.put(key, properties.content_length,
+								   _timestamp(properties.last_modified),
+								   properties.etag, getattr(properties, 'blob_type', None))
+
+	def _drop_data(self, containername, filename):
+		self.chunk_cache.invalidate_blob(containername, filename)
+		if self.disk_cache is not None:
+			self.disk_cache.invalidate_blob(containername, filename)
+
+	def _invalidate(self, path):
+		containername, filename = self._split_path(path)
+		self.attr_cache.invalidate((containername, filename))
+		self.opened_versions.invalidate((containername, filename))
+		self._drop_data(containername, filename)
+
+	def _get_range(self, containername, filename, etag, start, end):
+		# if_match makes Azure refuse the range if the blob has changed
+		# since attrs were cached, rather than mix two versions
+		blob = self.service.get_blob_to_bytes(containername, filename,
+											  start_range=start, end_range=end,
+											  max_connections=1, if_match=etag)
+		return blob.content
+
+	def _fetch_chunk(self, containername, filename, attrs, index, parallel=False):
+		start = index * self.chunk_size
+		end = min(start + self.chunk_size, attrs.content_length) - 1
+
+		def fetch_range(start, end):
+			return self._get_range(containername, filename, attrs.etag, start, end)
+
+		if parallel:
+			return fetch_parallel(fetch_range, start, end, self.parallelism,
+								  self.parallel_range_bytes)
+		if self.coalescer is not None:
+			# neighbouring chunks wanted at the same time, e.g. by clustered
+			# reads of a database file, are downloaded as one range
+			return self.coalescer.fetch((containername, filename, attrs.etag), start, end)
+		return fetch_range(start, end)
+
+	def _load_chunk(self, containername, filename, attrs, index, tag=None, parallel=False):
+		"""
+		Fetches a chunk from Azure into the memory cache and, when enabled,
+		the disk cache.
+
+		Concurrent loads of the same chunk, e.g. by several readers of one
+		blob or by a reader and the prefetcher, share a single request.
+		"""
+		key = (containername, filename, attrs.etag, index)
+		data, shared = self.flights.do(key, lambda: self._store_chunk(
+			containername, filename, attrs, index,
+			self._fetch_chunk(containername, filename, attrs, index, parallel), tag))
+		if shared and tag is None:
+			# count a speculative load this reader waited for as used
+			self.chunk_cache.get(key)
+		return data
+
+	def _store_chunk(self, containername, filename, attrs, index, data, tag=None):
+		self.chunk_cache.put((containername, filename, attrs.etag, index), data, tag)
+		if self.disk_cache is not None:
+			self.disk_cache.write(containername, filename, attrs.etag, attrs.content_length,
+								  index, data, attrs.last_modified)
+		return data
+
+	def _small_file_bytes(self, containername):
+		return self.small_file_overrides.get(containername, self.small_file_bytes)
+
+	def _preload(self, containername, filename, attrs):
+		"""
+		Downloads a whole blob with a single request into the read cache, so
+		reads through the handle being opened never go to the network.
+		"""
+		indexes = range((attrs.content_length + self.chunk_size - 1) // self.chunk_size)
+		if all(self._is_cached(containername, filename, attrs, index) for index in indexes):
+			return
+		data = self.service.get_blob_to_bytes(containername, filename, max_connections=1,
+											  if_match=attrs.etag).content
+		self.preloaded += 1
+		for index in indexes:
+			start = index * self.chunk_size
+			self._store_chunk(containername, filename, attrs, index,
+							  data[start:start + self.chunk_size])
+
+	def _is_cached(self, containername, filename, attrs, index):
+		if (containername, filename, attrs.etag, index) in self.chunk_cache:
+			return True
+		return (self.disk_cache is not None and
+				self.disk_cache.has(containername, filename, attrs.etag, index))
+
+	def _prefetch_chunk(self, containername, filename, attrs, index, parallel=False,
+						tag='readahead'):
+		if not self._is_cached(containername, filename, attrs, index):
+			self._load_chunk(containername, filename, attrs, index, tag, parallel)
+
+	def _prefetch_hints(self, path, containername, filename, attrs):
+		"""
+		Starts loading the tail, and optionally the head, of blobs matching
+		PREFETCH_HINT_PATTERNS while open returns. Formats such as Parquet,
+		ORC and ZIP keep their index in a footer that is read first.
+		"""
+		if not any(fnmatch.fnmatch(path, pattern) for pattern in self.hint_patterns):
+			return
+		size = attrs.content_length
+		ranges = [(max(size - self.hint_footer_bytes, 0), size)]
+		if self.hint_header_bytes:
+			ranges.append((0, min(self.hint_header_bytes, size)))
+		indexes = set()
+		for start, end in ranges:
+			if start < end:
+				indexes.update(range(start // self.chunk_size, (end - 1) // self.chunk_size + 1))
+		self.hinted += 1
+		for index in sorted(indexes, reverse=True):
+			if not self._is_cached(containername, filename, attrs, index):
+				self.prefetcher.schedule((containername, filename, attrs.etag, index),
+					lambda index=index: self._prefetch_chunk(containername, filename, attrs,
+															 index, tag='hint'))
+
+	def _parallel(self, attrs, handle):
+		"""
+		Large blobs that are scanned sequentially, or read in order from the
+		start, are downloaded over several connections at once.
+		"""
+		return (handle is not None and handle.readahead.streaming and
+				attrs.content_length >= self.parallel_min_bytes)
+
+	def _read_ahead(self, containername, filename, attrs, handle, length, offset):
+		for index in handle.readahead.access(offset, length):
+			if index * self.chunk_size >= attrs.content_length:
+				break
+			key = (containername, filename, attrs.etag, index)
+			if not self._is_cached(containername, filename, attrs, index):
+				parallel = self._parallel(attrs, handle)
+				self.prefetcher.schedule(key, lambda index=index:
+					self._prefetch_chunk(containername, filename, attrs, index, parallel))
+
+	def _new_handle(self, path, writer=None):
+		fh = next(self._file_handles)
+		self.handles[fh] = OpenFile(path, ReadAhead(
+			self.chunk_size, self.readahead_chunks, max_streams=self.readahead_streams,
+			min_accuracy=self.readahead_min_accuracy), writer)
+		return fh
+
+	def _writer(self, containername, filename, attrs=None):
+		"""
+		Returns the writer shared by every handle writing the blob, making
+		one over the blob's current contents if there is none yet. Called
+		with _writers_lock held.
+		"""
+		key = (containername, filename)
+		writer = self.writers.get(key)
+		if writer is None:
+			if attrs is None:
+				attrs = self._lookup(containername, filename)
+			blob_type = attrs.blob_type
+			if blob_type is None:
+				# attrs revalidated from the disk cache do not record it
+				blob_type = self.service.get_blob_properties(
+					containername, filename).properties.blob_type
+			if blob_type == AppendWriter.blob_type:
+				writer = AppendWriter(self.services, containername, filename,
+									  self.upload_stats, attrs.content_length, attrs.etag)
+			elif blob_type == PageWriter.blob_type:
+				writer = PageWriter(self.services, containername, filename,
+									self.upload_stats, attrs.content_length, attrs.etag)
+			else:
+				writer = BlockWriter(
+					self.services, self.upload_pool, containername, filename,
+					self.upload_block_bytes, self.upload_stats, attrs.content_length, attrs.etag)
+				if attrs.content_length:
+					# only the blocks that get written to are transferred
+					writer.load_blocks()
+			self.writers[key] = writer
+		return writer
+
+	def _commit(self, path, writer):
+		"""
+		Commits the writer's blocks and caches the attributes of the blob
+		they make up.
+		"""
+		if writer.flush():
+			self._invalidate(path)
+			self.attr_cache.put(self._split_path(path), writer.size,
+								_timestamp(writer.last_modified), writer.etag,
+								writer.blob_type)
+
+	def _read(self, containername, filename, attrs, buf, offset, parallel=False):
+		"""
+		Copies the blob's bytes from offset on into the writable buffer buf
+		and returns how many were copied.
+		"""
+		end = min(offset + len(buf), attrs.content_length)
+		if offset >= end:
+			return 0
+		copied = 0
+		for index in range(offset // self.chunk_size, (end - 1) // self.chunk_size + 1):
+			start = index * self.chunk_size
+			low, high = max(offset - start, 0), min(end - start, self.chunk_size)
+			target = buf[copied:copied + high - low]
+			copied += high - low
+			data = self.chunk_cache.get((containername, filename, attrs.etag, index))
+			if data is None and self.disk_cache is not None:
+				if self.disk_cache.read_into(containername, filename, attrs.etag,
+											 start + low, target):
+					continue
+			if data is None:
+				data = self._load_chunk(containername, filename, attrs, index, parallel=parallel)
+			target[:] = memoryview(data)[low:high]
+		return copied
+
+	def stats(self):
+		stats = self.attr_cache.stats('attr')
+		stats.update(self.negative_cache.stats('negative'))
+		stats.update(self.chunk_cache.stats('chunk'))
+		if self.disk_cache is not None:
+			stats.update(self.disk_cache.stats('disk'))
+		stats.update(self.prefetcher.stats('prefetch'))
+		readahead = dict(self.readahead_totals)
+		for handle in list(self.handles.values()):
+			for key, value in handle.readahead.stats('').items():
+				readahead[key[1:]] += value
+		for key, value in readahead.items():
+			stats['readahead_' + key] = value
+		stats.update(self.parallelism.stats('parallel'))
+		stats.update(self.flights.stats('fetch'))
+		if self.coalescer is not None:
+			stats.update(self.coalescer.stats('coalesce'))
+		stats['preloaded_blobs'] = self.preloaded
+		stats['hinted_opens'] = self.hinted
+		stats['revalidated_unchanged'] = self.revalidated
+		stats['revalidated_changed'] = self.changed
+		stats['zero_copy_reads'] = self.zero_copy_reads
+		stats['copied_reads'] = self.copied_reads
+		stats['zero_copy_writes'] = self.zero_copy_writes
+		stats['copied_writes'] = self.copied_writes
+		stats['kept_page_cache'] = self.kept_page_cache
+		stats['direct_io_opens'] = self.direct_io_opens
+		stats.update(self.upload_stats.stats('upload'))
+		stats.update(self.upload_pool.stats('upload'))
+		writers = list(self.writers.values())
+		stats['upload_open_writers'] = len(writers)
+		stats['upload_dirty_bytes'] = sum(writer.dirty_bytes for writer in writers)
+		stats.update(self.containers.stats('containers'))
+		return stats
+
 	def _get_container_reference(self, prefix='container'):
 		return '{}{}'.format(prefix, str(uuid.uuid4()).replace('-', ''))
 
@@ -72,36 +516,51 @@ class Passthrough(Operations):
 	def chown(self, path, uid, gid):
 		pass
 
-	def getattr(self, path, fh=None):
-		if debug:
-			print "getattr  " + path 
-		isFolder = False
-		if len(path.split('/')) == 2:
-			isFolder = True
-
-		"""link_data = {
+	def _folder_data(self):
+		return {
 			"st_ctime" : 1456615173,
 			"st_mtime" : 1456615173,
 			"st_nlink" : 2,
-			"st_mode" : 16893,
+#			"st_mode" : 16893,
+			"st_mode" : 16895,
 			"st_size" : 2,
 			"st_gid" : 1000,
 			"st_uid" : 1000,
 			"st_atime" : time(),
-		}"""
+		}
 
+	def _file_data(self, attrs):
+		return {
+			"st_ctime" : attrs.last_modified,
+			"st_mtime" : attrs.last_modified,
+			"st_nlink" : 1,
+#			"st_mode" : 33188,
+			"st_mode" : 33279,
+			"st_size" : attrs.content_length,
+			"st_gid" : 1000,
+			"st_uid" : 1000,
+			"st_atime" : time(),
+		}
 
-		folder_data = {
+	def getattr(self, path, fi=None):
+		if debug:
+			print "getattr  " + path 
+		containername, filename = self._split_path(path)
+		isFolder = filename is None
+
+		"""link_data = {
 			"st_ctime" : 1456615173,
 			"st_mtime" : 1456615173,
 			"st_nlink" : 2,
-#			"st_mode" : 16893,
-			"st_mode" : 16895,
+			"st_mode" : 16893,
 			"st_size" : 2,
 			"st_gid" : 1000,
 			"st_uid" : 1000,
 			"st_atime" : time(),
-		}
+		}"""
+
+
+		folder_data = self._folder_data()
 
 		
 		full_path = self._full_path(path)
@@ -114,36 +573,25 @@ class Passthrough(Operations):
 		#if os.path.isfile == True:
 		#	return 
 		if isFolder:
-			for container in list(self.service.list_containers()):
-				if container.name == path[1:]:
-					return folder_data
+			if containername in self.containers:
+				return folder_data
 		else:
 			"""import config as config
 			account_name = config.STORAGE_ACCOUNT_NAME
 			account_key = config.STORAGE_ACCOUNT_KEY"""
-			containername = path.split('/')[1]
-			filename = path.split('/')[2]
-			"""block_blob_service = BlockBlobService(account_name, account_key)
-			if os.path.isfile(full_path) == False:
-				fileSize = 1
-			else:
-				try:
-					pass
-					fileSize = os.path.getsize(full_path)
-				except:
-					fileSize = 1"""
-			self.service = self.account.create_block_blob_service()
-			file_data = {
-				"st_ctime" : 1456615173,
-				"st_mtime" : 1456615173,
-				"st_nlink" : 1,
-#				"st_mode" : 33188,
-				"st_mode" : 33279,
-				"st_size" : self.service.get_blob_properties(containername, filename).properties.content_length,
-				"st_gid" : 1000,
-				"st_uid" : 1000,
-				"st_atime" : time(),
-			}
+			writer = self.writers.get((containername, filename))
+			if writer is not None:
+				# the writer knows the size, which the blob does not have until
+				# it is committed, so there is nothing to look up
+				attrs = self.attr_cache.peek((containername, filename))
+				if attrs is None:
+					attrs = BlobAttrs(writer.size, _timestamp(writer.last_modified),
+									  writer.etag, False, writer.blob_type)
+				return self._file_data(attrs._replace(content_length=writer.size))
+			attrs = self._lookup(containername, filename)
+			if attrs.is_dir:
+				return folder_data
+			file_data = self._file_data(attrs)
 			return file_data
 
 		st = os.lstat(full_path)
@@ -151,28 +599,81 @@ class Passthrough(Operations):
 		rdata = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
 		return rdata
 
-	def readdir(self, path, fh):
+	def opendir(self, path):
+		fh = next(self._dir_handles)
+		self.dir_pages[fh] = None
+		return fh
+
+	def releasedir(self, path, fh):
+		self.dir_pages.pop(fh, None)
+		return 0
+
+	def _list_page(self, folder, prefix, start, marker):
+		"""
+		Lists one page of READDIR_PAGE_SIZE blobs below prefix and returns
+		it as (start, entries, next_marker), where entries are (name, attrs)
+		pairs and start is the position of the first of them.
+		"""
+		# The delimiter rolls everything below the next '/' up into a
+		# single BlobPrefix, so only the entries of this level are sent
+		blobs = self.service.list_blobs(folder, prefix=prefix or None, delimiter='/',
+										num_results=self.readdir_page_size,
+										marker=marker)
+		entries = []
+		for blob in blobs:
+			name = blob.name[len(prefix):].rstrip('/')
+			if isinstance(blob, BlobPrefix):
+				self.attr_cache.put_directory((folder, blob.name.rstrip('/')))
+				entries.append((name, self._folder_data()))
+			elif name:
+				# list_blobs already returns the properties getattr needs, so
+				# seed the attribute cache instead of paying a HEAD per entry
+				attrs = self._cache_properties(folder, blob.name, blob.properties)
+				entries.append((name, self._file_data(attrs)))
+			else:
+				# the blob named after the directory itself still takes a position
+				entries.append((None, None))
+		return start, entries, blobs.next_marker
+
+	def readdir(self, path, fh, offset=0):
+		"""
+		Entries are yielded as (name, attrs, offset) where offset is the
+		position of the next entry, so the kernel can resume a partially
+		consumed listing by calling readdir again with that offset.
+
+		Blobs are listed one page of READDIR_PAGE_SIZE entries at a time. The
+		last page fetched is kept on the directory handle, so the kernel's
+		resumed calls are answered from it and each page is listed only once;
+		only an offset before that page lists the directory again.
+		"""
 		if debug:
 			print "readdir  " + path  
 		
 		full_path = self._full_path(path)
 
-		dirents = ['.', '..']
 		#if os.path.isdir(full_path):
 		#	dirents.extend(os.listdir(full_path))
-		for r in dirents:
-			yield r
-		containers = list(self.service.list_containers())
-		#print('All containers in your account:')
+		for position in range(offset, len(DIRENTS)):
+			yield DIRENTS[position], None, position + 1
 		if path == "/":
-			for container in containers:
-				yield container.name
+			names = self.containers.names()
+			for position in range(max(offset, len(DIRENTS)), len(names) + len(DIRENTS)):
+				yield names[position - len(DIRENTS)], self._folder_data(), position + 1
 		else: 
-			folder = path[1:]
-			blobs = list(self.service.list_blobs(folder))
-			for blob in blobs:
-				yield blob.name
-			
+			folder, prefix = self._split_path(path)
+			prefix = prefix + '/' if prefix else ''
+			page = self.dir_pages.get(fh)
+			if page is None or max(offset, len(DIRENTS)) < page[0]:
+				page = self.dir_pages[fh] = self._list_page(folder, prefix, len(DIRENTS), None)
+			while True:
+				start, entries, marker = page
+				for position in range(max(offset, start), start + len(entries)):
+					name, attrs = entries[position - start]
+					if name:
+						yield name, attrs, position + 1
+				if not marker:
+					break
+				page = self.dir_pages[fh] = self._list_page(folder, prefix, start + len(entries), marker)
 
 	def readlink(self, path):
 		if debug:
@@ -192,6 +693,7 @@ class Passthrough(Operations):
 		if debug:
 			print "rmdir  " + path[1:]
 		deleted = self.service.delete_container(path[1:])
+		self.containers.discard(path[1:])
 		return 0
 
 	def mkdir(self, path, mode):
@@ -216,6 +718,8 @@ class Passthrough(Operations):
 
 		# TODO: validate input 
 		self.service.create_container(path[1:])
+		self.containers.add(path[1:])
+		self.negative_cache.invalidate_container(path[1:])
 		return 0
 
 	def statfs(self, path):
@@ -226,7 +730,11 @@ class Passthrough(Operations):
 			'f_frsize', 'f_namemax'))
 
 	def unlink(self, path):
-		return os.unlink(self._full_path(path))
+		self._invalidate(path)
+		containername, filename = self._split_path(path)
+		self.service.delete_blob(containername, filename)
+		self.negative_cache.add((containername, filename))
+		return 0
 
 	def symlink(self, name, target):
 		return os.symlink(name, self._full_path(target))
@@ -237,6 +745,13 @@ class Passthrough(Operations):
 		2) stream contents of old container to new container
 		3) delete old container
 		"""
+		for container in (old[1:], new[1:]):
+			self.attr_cache.invalidate_container(container)
+			self.opened_versions.invalidate_container(container)
+			self.chunk_cache.invalidate_container(container)
+			if self.disk_cache is not None:
+				self.disk_cache.invalidate_container(container)
+
 		# step 1 
 		self.mkdir(new, 0777)
 
@@ -262,7 +777,30 @@ class Passthrough(Operations):
 	# File methods
 	# ============
 
-	def open(self, path, flags):
+	def _direct_io(self, path):
+		return any(fnmatch.fnmatch(path, pattern) for pattern in self.direct_io_patterns)
+
+	def _set_cache_policy(self, path, attrs, fi):
+		"""
+		Lets the kernel keep the pages it cached for the blob if they are of
+		the version being opened, and bypass its page cache entirely for
+		DIRECT_IO_PATTERNS, e.g. files that are only ever streamed once.
+		"""
+		if self._direct_io(path):
+			fi.direct_io = 1
+			self.direct_io_opens += 1
+			return
+		key = self._split_path(path)
+		if attrs is not None and not attrs.is_dir:
+			if self.opened_versions.get(key) == attrs.etag:
+				fi.keep_cache = 1
+				self.kept_page_cache += 1
+			self.opened_versions.put(key, attrs.etag)
+		else:
+			# opened for writing; whatever the kernel holds is about to be stale
+			self.opened_versions.invalidate(key)
+
+	def open(self, path, fi):
 		"""if debug:
 			print "open:    " + path
 			print flags
@@ -287,36 +825,84 @@ class Passthrough(Operations):
 			pass
 		print "full path:   " + full_path 
 		print os.path.isfile(full_path)"""
-		return 0#os.open(full_path, flags)
+		containername, filename = self._split_path(path)
+		attrs = None
+		if filename is not None and fi.flags & O_ACCMODE != os.O_WRONLY:
+			# the size is usually known already from a listing or a stat
+			attrs = self._lookup(containername, filename)
+			if not attrs.is_dir and 0 < attrs.content_length <= self._small_file_bytes(containername):
+				try:
+					self._preload(containername, filename, attrs)
+				except AzureHttpError as e:
+					if e.status_code != 412:
+						raise
+					# changed since it was listed; read will pick up the new version
+					self._invalidate(path)
+					attrs = self._lookup(containername, filename)
+			elif not attrs.is_dir and attrs.content_length:
+				self._prefetch_hints(path, containername, filename, attrs)
+		writer = None
+		writing = filename is not None and fi.flags & O_ACCMODE != os.O_RDONLY
+		self._set_cache_policy(path, None if writing else attrs, fi)
+		with self._writers_lock:
+			if writing:
+				writer = self._writer(containername, filename)
+			fi.fh = self._new_handle(path, writer)#os.open(full_path, flags)
+		if writer is not None and fi.flags & os.O_TRUNC:
+			writer.truncate(0)
+		return 0
 
-	def create(self, path, mode, fi=None):
+	def create(self, path, mode, fi):
+		"""
+		Creates an empty blob right away so the file is visible to others
+		and to getattr; its contents are uploaded as they are written.
+		"""
 		if debug:
 			print "create:   " + path
-		full_path = self._full_path(path)
-		return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+		containername, filename = self._split_path(path)
+		self.negative_cache.invalidate((containername, filename))
+		self._set_cache_policy(path, None, fi)
+		with self._writers_lock:
+			writer = self.writers.get((containername, filename))
+			if writer is None:
+				if containername in self.page_blob_containers or any(
+						fnmatch.fnmatch(path, pattern) for pattern in self.page_blob_patterns):
+					# disk images, databases and the like are written at random offsets
+					writer = PageWriter(self.services, containername, filename,
+										self.upload_stats)
+				elif fi.flags & os.O_APPEND or any(fnmatch.fnmatch(path, pattern)
+												   for pattern in self.append_blob_patterns):
+					# logs and the like are only ever appended to
+					writer = AppendWriter(self.services, containername, filename,
+										  self.upload_stats)
+				else:
+					writer = BlockWriter(
+						self.services, self.upload_pool, containername, filename,
+						self.upload_block_bytes, self.upload_stats)
+				self.writers[(containername, filename)] = writer
+				writer.create()
+				self._invalidate(path)
+				self.attr_cache.put((containername, filename), 0,
+									_timestamp(writer.last_modified), writer.etag,
+									writer.blob_type)
+			fi.fh = self._new_handle(path, writer)
+		return 0
 
-	def read(self, path, length, offset, fh):
+	def read(self, path, length, offset, fi):
 		if debug:
 			print "read:	   " + path
 			print "offset:  " 
 			print offset
 			print "length: "
 			print length 
-			print fh
+			print fi.fh
 		full_path = self._full_path(path)
 		print full_path
 		#os.lseek(fh, offset, os.SEEK_SET)
 		#if os.path.isfile(full_path) == False:
-		import config as config
-		account_name = config.STORAGE_ACCOUNT_NAME
-		account_key = config.STORAGE_ACCOUNT_KEY
-		containername = path.split('/')[1]
-		filename = path.split('/')[2]
-		service = baseblobservice.BaseBlobService(account_name, account_key)
-		blob = service.get_blob_to_bytes(containername, filename, None, offset, offset+length-1)
-		#blob = blob[offset:(offset+length)]
-		bytes = blob.content 
-		return bytes
+		self.copied_reads += 1
+		buf = bytearray(length)
+		return bytes(buf[:self._read_into(path, memoryview(buf), offset, fi.fh)])
 		"""try:
 			if os.path.isdir(path.split('/')[1]) == False:
 				os.mkdir(full_path.split('/')[0]+'/'+containername)
@@ -336,33 +922,146 @@ class Passthrough(Operations):
 		#print os.read(fh, length)
 		return os.read(fhn, length)"""
 
-	def write(self, path, buf, offset, fh):
+	def read_into(self, path, buf, offset, fi):
+		"""
+		Fills buf, a memoryview of the kernel's read buffer, straight from the
+		caches instead of returning a string that FUSE has to copy again.
+		"""
+		if debug:
+			print "read_into:   " + path
+		self.zero_copy_reads += 1
+		return self._read_into(path, buf, offset, fi.fh)
+
+	def _read_into(self, path, buf, offset, fh):
+		containername, filename = self._split_path(path)
+		writer = self.writers.get((containername, filename))
+		if writer is not None and writer.changed:
+			# reads are served from the blob, so it has to hold the writes
+			self._commit(path, writer)
+		attrs = self._lookup(containername, filename)
+		handle = self.handles.get(fh)
+		parallel = self._parallel(attrs, handle)
+		try:
+			count = self._read(containername, filename, attrs, buf, offset, parallel)
+		except AzureHttpError as e:
+			if e.status_code != 412:
+				raise
+			# the blob was replaced behind our back; start over with its
+			# current attributes
+			self._invalidate(path)
+			attrs = self._lookup(containername, filename)
+			count = self._read(containername, filename, attrs, buf, offset, parallel)
+		if handle is not None and count:
+			self._read_ahead(containername, filename, attrs, handle, count, offset)
+		return count
+
+	def write(self, path, buf, offset, fi):
 		if debug:
 			print "write:   " + path
-		os.lseek(fh, offset, os.SEEK_SET)
-		return os.write(fh, buf)
+		self.copied_writes += 1
+		return self._write(path, buf, offset, fi.fh)
 
-	def truncate(self, path, length, fh=None):
+	def write_from(self, path, buf, offset, fi):
+		"""
+		Takes buf as a memoryview of the kernel's write buffer, valid only
+		for the duration of the call, and writes it without an intermediate
+		string.
+		"""
+		if debug:
+			print "write_from:   " + path
+		self.zero_copy_writes += 1
+		return self._write(path, buf, offset, fi.fh)
+
+	def _write(self, path, buf, offset, fh):
+		writer = self.handles[fh].writer
+		if writer is None:
+			raise FuseOSError(errno.EBADF)
+		if not writer.changed:
+			# the first write since the last commit makes cached data stale;
+			# _commit caches the new attributes
+			self._invalidate(path)
+		return writer.write(buf, offset)
+
+	def truncate(self, path, length, fi=None):
 		print "truncate:   " + path
-		full_path = self._full_path(path)
-		with open(full_path, 'r+') as f:
-			f.truncate(length)
+		containername, filename = self._split_path(path)
+		with self._writers_lock:
+			writer = self._writer(containername, filename)
+			self._invalidate(path)
+			writer.truncate(length)
+			if not any(handle.writer is writer for handle in self.handles.values()):
+				# nobody has the file open for writing, so nothing else will commit
+				try:
+					self._commit(path, writer)
+				finally:
+					del self.writers[(containername, filename)]
 
-	def flush(self, path, fh):
+	def flush(self, path, fi):
 		print "flush:   " + path
-		return os.fsync(fh)
+		writer = self.handles[fi.fh].writer
+		if writer is not None:
+			self._commit(path, writer)
+		return 0
 
-	def release(self, path, fh):
+	def release(self, path, fi):
 		print "release:   " + path
-		return os.close(fh)
+		with self._writers_lock:
+			handle = self.handles.pop(fi.fh)
+		for key, value in handle.readahead.stats('').items():
+			self.readahead_totals[key[1:]] += value
+		if not handle.readahead.enabled:
+			self.readahead_totals['disabled_handles'] += 1
+		writer = handle.writer
+		if writer is not None:
+			try:
+				self._commit(path, writer)
+			finally:
+				with self._writers_lock:
+					key = self._split_path(path)
+					if self.writers.get(key) is writer and not any(
+							other.writer is writer for other in self.handles.values()):
+						del self.writers[key]
+		return 0
 
-	def fsync(self, path, fdatasync, fh):
+	def fsync(self, path, fdatasync, fi):
 		print "fsync:   " + path
-		return self.flush(path, fh)
+		return self.flush(path, fi)
+
+	def getxattr(self, path, name, position=0):
+		# the kernel asks for security.capability on every write, so answer
+		# anything that is not a stats attribute before gathering the stats
+		if path != '/' or not name.startswith(STATS_XATTR_PREFIX):
+			raise FuseOSError(errno.ENODATA)
+		stats = self.stats()
+		key = name[len(STATS_XATTR_PREFIX):]
+		if key in stats:
+			return str(stats[key])
+		raise FuseOSError(errno.ENODATA)
+
+	def listxattr(self, path):
+		if path == '/':
+			return [STATS_XATTR_PREFIX + key for key in sorted(self.stats())]
+		return []
+
+	def init(self, path):
+		self.containers.start()
+
+	def destroy(self, path):
+		self.containers.stop()
+		self.prefetcher.stop()
+		self.upload_pool.stop()
+		self.services.close()
+		if debug:
+			for key, value in sorted(self.stats().items()):
+				print key + ":  " + str(value)
 
 
 def main(mountpoint, root):
-	FUSE(Passthrough(root), mountpoint, nothreads=True, foreground=True)
+	# raw_fi hands open the fuse_file_info, so it can set keep_cache and
+	# direct_io; every other file operation then receives it in place of fh
+	import config as config
+	FUSE(Passthrough(root), mountpoint, raw_fi=True,
+		 nothreads=not getattr(config, 'FUSE_THREADS', False), foreground=True)
 
 if __name__ == '__main__':
 	main(sys.argv[2], sys.argv[1])
@@ -0,0 +1,315 @@
+"""
+@name cache.py
+
+In-process caches used by blobfs to avoid repeating Azure round trips.
+"""
+import threading
+
+from collections import namedtuple, OrderedDict
+from time import time
+
+
+BlobAttrs = namedtuple('BlobAttrs', 'content_length last_modified etag is_dir blob_type')
+
+
+class _TTLCache(object):
+	"""
+	LRU mapping whose entries expire ``ttl`` seconds after insertion.
+
+	Lookups are counted as hits or misses so callers can report how well the
+	cache is doing.
+	"""
+
+	def __init__(self, ttl, max_entries):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def _get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				expires, value = entry
+				if expires > time():
+					# move to the most recently used end
+					del self._entries[key]
+					self._entries[key] = entry
+					self.hits += 1
+					return value
+				del self._entries[key]
+			self.misses += 1
+			return None
+
+	def _put(self, key, value):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (time() + self.ttl, value)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+		return value
+
+	def invalidate(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def invalidate_container(self, container):
+		with self._lock:
+			for key in [k for k in self._entries if k[0] == container]:
+				del self._entries[key]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self, prefix):
+		lookups = self.hits + self.misses
+		return {
+			prefix + '_hits': self.hits,
+			prefix + '_misses': self.misses,
+			prefix + '_hit_rate': float(self.hits) / lookups if lookups else 0.0,
+			prefix + '_entries': len(self._entries),
+		}
+
+
+class AttrCache(_TTLCache):
+	"""
+	Blob attributes keyed by (container, blob).
+
+	Entries are BlobAttrs tuples holding the properties getattr needs:
+	content_length, last_modified (seconds since the epoch) and etag, along
+	with the blob_type when it is known. Virtual directories, i.e. blob name
+	prefixes, are cached with is_dir set.
+	"""
+
+	def __init__(self, ttl=5, max_entries=10000):
+		super(AttrCache, self).__init__(ttl, max_entries)
+
+	def get(self, key):
+		return self._get(key)
+
+	def peek(self, key):
+		"""Returns the entry even if it has expired, without counting a lookup."""
+		entry = self._entries.get(key)
+		return entry[1] if entry is not None else None
+
+	def put(self, key, content_length, last_modified, etag, blob_type=None):
+		return self._put(key, BlobAttrs(content_length, last_modified, etag, False, blob_type))
+
+	def put_directory(self, key):
+		return self._put(key, BlobAttrs(0, time(), None, True, None))
+
+
+class NegativeCache(_TTLCache):
+	"""
+	(container, blob) keys recently found not to exist.
+
+	Entries are kept only for a short ``ttl`` so that blobs created by other
+	clients show up quickly; blobs and containers created through this
+	mount invalidate them directly.
+	"""
+
+	def __init__(self, ttl=2, max_entries=10000):
+		super(NegativeCache, self).__init__(ttl, max_entries)
+
+	def __contains__(self, key):
+		return self._get(key) is not None
+
+	def add(self, key):
+		self._put(key, True)
+
+
+class OpenedVersions(_TTLCache):
+	"""
+	Etag of each (container, blob) as of the last time it was opened, i.e.
+	the version whose pages the kernel may still hold in its page cache.
+
+	Entries never expire; the least recently opened blobs are dropped once
+	there are more than ``max_entries``.
+	"""
+
+	def __init__(self, max_entries=10000):
+		super(OpenedVersions, self).__init__(float('inf'), max_entries)
+
+	def get(self, key):
+		return self._get(key)
+
+	def put(self, key, etag):
+		return self._put(key, etag)
+
+
+class ChunkCache(object):
+	"""
+	Byte-bounded LRU of blob contents split into fixed-size chunks.
+
+	Chunks are keyed by (container, blob, etag, index). Including the etag
+	means a rewritten blob never serves chunks of its previous version; those
+	simply age out, or are dropped at once through invalidate_blob().
+
+	Chunks loaded speculatively are put with a tag naming what loaded them.
+	The first get() of such a chunk counts its bytes as used for that tag;
+	chunks evicted or invalidated before anyone read them count as wasted.
+	"""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._chunks = OrderedDict()
+		self._blobs = {}
+		self._tags = {}
+		self._lock = threading.Lock()
+
+	def __contains__(self, key):
+		return key in self._chunks
+
+	def get(self, key):
+		with self._lock:
+			entry = self._chunks.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			self._chunks[key] = entry
+			self.hits += 1
+			data, tag = entry
+			if tag is not None:
+				self._tags[tag]['used'] += len(data)
+				entry[1] = None
+			return data
+
+	def put(self, key, data, tag=None):
+		with self._lock:
+			self._remove(key)
+			self._chunks[key] = [data, tag]
+			self._blobs.setdefault(key[:2], set()).add(key)
+			self.size += len(data)
+			if tag is not None:
+				counters = self._tags.setdefault(tag, dict(loaded=0, used=0, wasted=0))
+				counters['loaded'] += len(data)
+			while self.size > self.max_bytes and self._chunks:
+				self._remove(next(iter(self._chunks)))
+				self.evictions += 1
+		return data
+
+	def _remove(self, key):
+		entry = self._chunks.pop(key, None)
+		if entry is not None:
+			data, tag = entry
+			self.size -= len(data)
+			if tag is not None:
+				self._tags[tag]['wasted'] += len(data)
+			keys = self._blobs[key[:2]]
+			keys.discard(key)
+			if not keys:
+				del self._blobs[key[:2]]
+
+	def invalidate_blob(self, container, blob):
+		with self._lock:
+			for key in list(self._blobs.get((container, blob), ())):
+				self._remove(key)
+
+	def invalidate_container(self, container):
+		with self._lock:
+			for key in [k for k in self._chunks if k[0] == container]:
+				self._remove(key)
+
+	def stats(self, prefix):
+		lookups = self.hits + self.misses
+		stats = {
+			prefix + '_hits': self.hits,
+			prefix + '_misses': self.misses,
+			prefix + '_hit_rate': float(self.hits) / lookups if lookups else 0.0,
+			prefix + '_evictions': self.evictions,
+			prefix + '_bytes': self.size,
+		}
+		for tag, counters in self._tags.items():
+			for name, value in counters.items():
+				stats['%s_%s_bytes' % (tag, name)] = value
+		return stats
+
+
+class ContainerIndex(object):
+	"""
+	Set of the account's container names for O(1) membership checks.
+
+	The set is loaded on first use and then refreshed from list_containers
+	every ``interval`` seconds on a background thread once start() has been
+	called. Changes made through add() and discard() take effect immediately
+	and survive a refresh that was already in progress.
+	"""
+
+	def __init__(self, list_containers, interval=30):
+		self.interval = interval
+		self.refreshes = 0
+		self._list_containers = list_containers
+		self._names = None
+		self._changes = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	def refresh(self):
+		with self._lock:
+			self._changes = {}
+		names = set(self._list_containers())
+		with self._lock:
+			for name, present in self._changes.items():
+				if present:
+					names.add(name)
+				else:
+					names.discard(name)
+			self._names = names
+			self.refreshes += 1
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			try:
+				self.refresh()
+			except Exception:
+				# keep serving the last good listing until the next attempt
+				pass
+
+	def start(self):
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run, name='blobfs-containers')
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+
+	def _loaded(self):
+		if self._names is None:
+			self.refresh()
+		return self._names
+
+	def __contains__(self, name):
+		return name in self._loaded()
+
+	def names(self):
+		return sorted(self._loaded())
+
+	def add(self, name):
+		with self._lock:
+			self._changes[name] = True
+			if self._names is not None:
+				self._names.add(name)
+
+	def discard(self, name):
+		with self._lock:
+			self._changes[name] = False
+			if self._names is not None:
+				self._names.discard(name)
+
+	def stats(self, prefix):
+		return {
+			prefix + '_refreshes': self.refreshes,
+			prefix + '_count': len(self._names or ()),
+		}
@@ -2,3 +2,117 @@ STORAGE_ACCOUNT_NAME = ''
 STORAGE_ACCOUNT_KEY = ''
 SAS = ''
 IS_EMULATED = False
+
+# Seconds a blob's attributes are served from memory before they are
+# fetched from Azure again, and the maximum number of cached blobs.
+ATTR_CACHE_TTL = 5
+ATTR_CACHE_SIZE = 10000
+
+# Seconds between background refreshes of the list of containers.
+CONTAINER_REFRESH_INTERVAL = 30
+
+# Seconds a lookup of a missing blob is remembered, and the maximum number
+# of remembered misses.
+NEGATIVE_CACHE_TTL = 2
+NEGATIVE_CACHE_SIZE = 10000
+
+# Number of blobs requested per list_blobs page when listing a directory.
+READDIR_PAGE_SIZE = 1000
+
+# Maximum number of kept-alive HTTPS connections shared by the mount.
+CONNECTION_POOL_SIZE = 16
+
+# Reads are served from an in-memory cache of READ_CHUNK_SIZE byte blob
+# chunks holding at most READ_CACHE_BYTES bytes.
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+READ_CACHE_BYTES = 256 * 1024 * 1024
+
+# Sequential readers get up to READAHEAD_CHUNKS chunks prefetched ahead of
+# them by PREFETCH_WORKERS background threads.
+READAHEAD_CHUNKS = 8
+PREFETCH_WORKERS = 4
+
+# Up to READAHEAD_STREAMS interleaved sequential cursors per open file are
+# followed, and evenly spaced seeks are prefetched along their stride. A
+# file on which fewer than READAHEAD_MIN_ACCURACY of the prefetched chunks
+# get read stops prefetching.
+READAHEAD_STREAMS = 4
+READAHEAD_MIN_ACCURACY = 0.25
+
+# Chunks are also kept in the root cache directory given on the command
+# line, up to DISK_CACHE_BYTES bytes, and reused across remounts. Set to 0
+# to disable the disk cache.
+DISK_CACHE_BYTES = 10 * 1024 ** 3
+
+# Sequential scans of blobs of at least PARALLEL_DOWNLOAD_MIN_BYTES fetch
+# each chunk as up to MAX_PARALLEL_RANGES concurrent ranged requests of at
+# least PARALLEL_RANGE_BYTES bytes, so no more than READ_CHUNK_SIZE //
+# PARALLEL_RANGE_BYTES of them. The number of ranges adapts to the
+# throughput observed per connection.
+PARALLEL_DOWNLOAD_MIN_BYTES = 64 * 1024 * 1024
+MAX_PARALLEL_RANGES = 8
+PARALLEL_RANGE_BYTES = 1024 * 1024
+
+# Blobs of at most SMALL_FILE_BYTES bytes are downloaded whole when they are
+# opened. SMALL_FILE_BYTES_BY_CONTAINER overrides the threshold per
+# container, e.g. {'images': 8 * 1024 * 1024}.
+SMALL_FILE_BYTES = 1024 * 1024
+SMALL_FILE_BYTES_BY_CONTAINER = {}
+
+# Copy read data directly into the kernel's buffer. Turning this off falls
+# back to returning a string from read, e.g. to compare their CPU cost.
+ZERO_COPY_READS = True
+
+# Hand written data to the filesystem as a view of the kernel's buffer
+# instead of a copied string.
+ZERO_COPY_WRITES = True
+
+# The kernel keeps its page cache of a blob across opens as long as the
+# blob's etag has not changed. Paths matching one of the DIRECT_IO_PATTERNS
+# globs bypass the page cache instead, e.g. ['/logs/*', '*.tar'].
+DIRECT_IO_PATTERNS = []
+
+# Serve FUSE requests on multiple threads, so reads of different files, or
+# of the same hot blob by several processes, overlap instead of queueing.
+# Concurrent fetches of the same chunk are always made only once.
+FUSE_THREADS = False
+
+# Chunk downloads of the same blob that start within READ_COALESCE_WINDOW
+# seconds of each other are merged into one ranged request when they are
+# at most READ_COALESCE_GAP bytes apart, up to READ_COALESCE_MAX_BYTES per
+# request. This helps clustered random reads, e.g. of database files, with
+# FUSE_THREADS on and a small READ_CHUNK_SIZE. 0 disables coalescing.
+READ_COALESCE_WINDOW = 0
+READ_COALESCE_GAP = 64 * 1024
+READ_COALESCE_MAX_BYTES = 16 * 1024 * 1024
+
+# Opening a blob whose path matches one of the PREFETCH_HINT_PATTERNS
+# globs, e.g. ['*.parquet', '*.orc', '*.zip'], loads its last
+# PREFETCH_FOOTER_BYTES and first PREFETCH_HEADER_BYTES bytes in the
+# background, so reading the footer does not wait on a request.
+PREFETCH_HINT_PATTERNS = []
+PREFETCH_FOOTER_BYTES = 1024 * 1024
+PREFETCH_HEADER_BYTES = 0
+
+# Files written through the mount are uploaded as blocks of
+# UPLOAD_BLOCK_BYTES bytes while they are written and committed when they
+# are flushed or closed. A block blob holds at most 50,000 blocks, so this
+# also bounds the size of the files that can be written.
+UPLOAD_BLOCK_BYTES = 4 * 1024 * 1024
+
+# Blocks are uploaded by UPLOAD_WORKERS threads at once. Writes block while
+# UPLOAD_MAX_IN_FLIGHT_BYTES bytes of blocks are waiting to be uploaded.
+UPLOAD_WORKERS = 8
+UPLOAD_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+# Files created with O_APPEND, or whose path matches one of the
+# APPEND_BLOB_PATTERNS globs, e.g. ['/logs/*'], are stored as append blobs.
+# Every flush then appends only the bytes written since the last one.
+APPEND_BLOB_PATTERNS = []
+
+# Files created in one of the PAGE_BLOB_CONTAINERS, or whose path matches
+# one of the PAGE_BLOB_PATTERNS globs, e.g. ['*.vhd', '*.sqlite'], are
+# stored as page blobs, which take writes at any offset. Their size is
+# always rounded up to a multiple of 512 bytes.
+PAGE_BLOB_PATTERNS = []
+PAGE_BLOB_CONTAINERS = []
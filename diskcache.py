@@ -0,0 +1,283 @@
+"""
+@name diskcache.py
+
+Persistent cache of blob chunks on local disk.
+"""
+import io
+import os
+import json
+import errno
+import hashlib
+import binascii
+import threading
+
+from collections import OrderedDict
+from time import time
+
+
+def _preadinto(fd, buf, offset):
+	if hasattr(os, 'preadv'):
+		return os.preadv(fd, [buf], offset)
+	os.lseek(fd, offset, os.SEEK_SET)
+	return io.FileIO(fd, closefd=False).readinto(buf)
+
+
+def _pwrite(fd, data, offset):
+	if hasattr(os, 'pwrite'):
+		return os.pwrite(fd, data, offset)
+	os.lseek(fd, offset, os.SEEK_SET)
+	return os.write(fd, data)
+
+
+def _remove(path):
+	try:
+		os.unlink(path)
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+
+class _Entry(object):
+	"""Metadata of one cached blob."""
+
+	def __init__(self, container, blob, etag, size, chunk_size, bitmap=None,
+				 last_modified=None):
+		self.container = container
+		self.blob = blob
+		self.etag = etag
+		self.size = size
+		self.last_modified = last_modified
+		self.chunk_size = chunk_size
+		chunks = (size + chunk_size - 1) // chunk_size
+		self.bitmap = bitmap or bytearray((chunks + 7) // 8)
+		self.bytes = sum(self.chunk_length(i) for i in range(chunks) if self.has(i))
+		self.accessed = time()
+
+	def chunk_length(self, index):
+		return min(self.chunk_size, self.size - index * self.chunk_size)
+
+	def has(self, index):
+		return bool(self.bitmap[index // 8] & (1 << (index % 8)))
+
+	def set(self, index):
+		if not self.has(index):
+			self.bitmap[index // 8] |= 1 << (index % 8)
+			self.bytes += self.chunk_length(index)
+
+	def to_json(self):
+		return json.dumps({
+			'container': self.container,
+			'blob': self.blob,
+			'etag': self.etag,
+			'size': self.size,
+			'last_modified': self.last_modified,
+			'chunk_size': self.chunk_size,
+			'bitmap': binascii.hexlify(bytes(self.bitmap)).decode('ascii'),
+		})
+
+	@classmethod
+	def from_json(cls, text):
+		meta = json.loads(text)
+		return cls(meta['container'], meta['blob'], meta['etag'], meta['size'],
+				   meta['chunk_size'], bytearray(binascii.unhexlify(meta['bitmap'])),
+				   meta.get('last_modified'))
+
+
+class DiskCache(object):
+	"""
+	Chunk cache kept in a local directory so it survives remounts.
+
+	Every cached blob has a sparse data file holding its chunks at their
+	offsets within the blob, and a metadata file recording the blob's etag,
+	size, chunk size and a bitmap of the chunks present. A lookup with a
+	different etag discards the entry. The bytes of present chunks are kept
+	under ``max_bytes`` by evicting the least recently used blobs.
+	"""
+
+	def __init__(self, directory, max_bytes, chunk_size):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.chunk_size = chunk_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._load()
+
+	def _name(self, container, blob):
+		return hashlib.sha1(u'{}/{}'.format(container, blob).encode('utf-8')).hexdigest()
+
+	def _data_path(self, name):
+		return os.path.join(self.directory, name + '.data')
+
+	def _meta_path(self, name):
+		return os.path.join(self.directory, name + '.meta')
+
+	def _load(self):
+		"""
+		Rebuilds the index from the metadata files of a previous mount.
+
+		Files that no valid metadata accounts for, i.e. data written just
+		before a crash and temporary files of an interrupted save, would
+		otherwise take up space outside max_bytes forever and are deleted.
+		"""
+		entries = []
+		filenames = os.listdir(self.directory)
+		for filename in filenames:
+			if not filename.endswith('.meta'):
+				continue
+			name = filename[:-len('.meta')]
+			path = self._meta_path(name)
+			try:
+				with open(path) as f:
+					entry = _Entry.from_json(f.read())
+				entry.accessed = os.path.getmtime(path)
+			except (IOError, OSError, ValueError, KeyError):
+				entry = None
+			if entry is None or entry.chunk_size != self.chunk_size:
+				_remove(path)
+				continue
+			entries.append((entry.accessed, name, entry))
+		valid = set(self._data_path(name) for accessed, name, entry in entries)
+		for filename in filenames:
+			path = os.path.join(self.directory, filename)
+			if filename.endswith('.tmp') or (filename.endswith('.data') and path not in valid):
+				_remove(path)
+		for accessed, name, entry in sorted(entries):
+			self._entries[name] = entry
+			self.size += entry.bytes
+		self._evict()
+
+	def _save(self, name, entry):
+		path = self._meta_path(name)
+		with open(path + '.tmp', 'w') as f:
+			f.write(entry.to_json())
+		os.rename(path + '.tmp', path)
+
+	def _drop(self, name):
+		entry = self._entries.pop(name, None)
+		if entry is None:
+			# files only exist for entries; _load cleared any others
+			return
+		self.size -= entry.bytes
+		_remove(self._meta_path(name))
+		_remove(self._data_path(name))
+
+	def _evict(self, keep=None, needed=0):
+		for name in list(self._entries):
+			if self.size + needed <= self.max_bytes:
+				break
+			if name != keep:
+				self._drop(name)
+				self.evictions += 1
+
+	def _entry(self, container, blob, etag):
+		"""Returns the entry for that version of the blob, or None."""
+		name = self._name(container, blob)
+		entry = self._entries.get(name)
+		if entry is not None and entry.etag != etag:
+			self._drop(name)
+			entry = None
+		if entry is not None:
+			del self._entries[name]
+			self._entries[name] = entry
+			now = time()
+			if now - entry.accessed > 60:
+				# persist the access time for the LRU order after a remount
+				os.utime(self._meta_path(name), None)
+			entry.accessed = now
+		return name, entry
+
+	def stored(self, container, blob):
+		"""
+		Returns the entry of whichever version of the blob is cached, whose
+		etag, size and last_modified were current when it was written, or
+		None.
+		"""
+		with self._lock:
+			return self._entries.get(self._name(container, blob))
+
+	def has(self, container, blob, etag, index):
+		with self._lock:
+			name, entry = self._entry(container, blob, etag)
+			return entry is not None and entry.has(index)
+
+	def _open(self, container, blob, etag, offset, length):
+		"""
+		Opens the data file if every chunk spanned by ``length`` bytes at
+		``offset`` is cached, returns None otherwise.
+		"""
+		with self._lock:
+			name, entry = self._entry(container, blob, etag)
+			if entry is None or not all(entry.has(index) for index in
+					range(offset // self.chunk_size, (offset + length - 1) // self.chunk_size + 1)):
+				self.misses += 1
+				return None
+			self.hits += 1
+			return os.open(self._data_path(name), os.O_RDONLY)
+
+	def read_into(self, container, blob, etag, offset, buf):
+		"""
+		Fills the writable buffer ``buf`` with the bytes at ``offset`` if
+		they are all cached and returns True, returns False otherwise.
+		"""
+		fd = self._open(container, blob, etag, offset, len(buf))
+		if fd is None:
+			return False
+		try:
+			return _preadinto(fd, buf, offset) == len(buf)
+		finally:
+			os.close(fd)
+
+	def write(self, container, blob, etag, size, index, data, last_modified=None):
+		with self._lock:
+			name, entry = self._entry(container, blob, etag)
+			if entry is not None and entry.has(index):
+				return
+			self._evict(keep=name, needed=len(data))
+			if self.size + len(data) > self.max_bytes:
+				# the rest of this blob does not fit next to what is cached
+				return
+			if entry is None:
+				entry = _Entry(container, blob, etag, size, self.chunk_size,
+							   last_modified=last_modified)
+				self._entries[name] = entry
+			fd = os.open(self._data_path(name), os.O_WRONLY | os.O_CREAT, 0o600)
+			try:
+				if os.fstat(fd).st_size != size:
+					os.ftruncate(fd, size)
+				_pwrite(fd, data, index * self.chunk_size)
+				# the bitmap saved below must never mark a chunk whose bytes
+				# could still be lost in a crash; _load trusts it
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+			self.size -= entry.bytes
+			entry.set(index)
+			self.size += entry.bytes
+			self._save(name, entry)
+
+	def invalidate_blob(self, container, blob):
+		with self._lock:
+			self._drop(self._name(container, blob))
+
+	def invalidate_container(self, container):
+		with self._lock:
+			for name, entry in list(self._entries.items()):
+				if entry.container == container:
+					self._drop(name)
+
+	def stats(self, prefix):
+		lookups = self.hits + self.misses
+		return {
+			prefix + '_hits': self.hits,
+			prefix + '_misses': self.misses,
+			prefix + '_hit_rate': float(self.hits) / lookups if lookups else 0.0,
+			prefix + '_evictions': self.evictions,
+			prefix + '_bytes': self.size,
+			prefix + '_blobs': len(self._entries),
+		}
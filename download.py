@@ -0,0 +1,244 @@
+"""
+@name download.py
+
+Concurrent ranged downloads of a single blob.
+"""
+import threading
+
+from time import sleep, time
+
+
+class AdaptiveParallelism(object):
+	"""
+	Picks how many ranges of a blob are downloaded at once.
+
+	Every parallel download reports its per-stream throughput, which is
+	averaged per number of streams. While adding a stream still raises
+	the aggregate throughput (per-stream throughput times streams) by at
+	least ``gain`` over one stream fewer, the degree keeps growing up to
+	``max_degree``; once it does not, the link or the account is saturated
+	and the degree steps back down.
+
+	The decision is made from the number of streams a download actually
+	used, which may be fewer than the degree for short ranges, so the
+	degree never waits on a count that is not reached.
+	"""
+
+	def __init__(self, max_degree=8, initial=2, gain=1.05, smoothing=0.3):
+		self.max_degree = max_degree
+		self.degree = min(initial, max_degree)
+		self.gain = gain
+		self.smoothing = smoothing
+		self._throughput = {}
+		self._lock = threading.Lock()
+
+	def record(self, streams, nbytes, seconds):
+		if not nbytes or seconds <= 0:
+			return
+		per_stream = float(nbytes) / seconds / streams
+		with self._lock:
+			average = self._throughput.get(streams)
+			if average is not None:
+				per_stream = average + self.smoothing * (per_stream - average)
+			self._throughput[streams] = per_stream
+			fewer = self._throughput.get(streams - 1)
+			if fewer is None or streams * per_stream >= (streams - 1) * fewer * self.gain:
+				self.degree = min(streams + 1, self.max_degree)
+			else:
+				self.degree = max(streams - 1, 1)
+
+	def stats(self, prefix):
+		stats = {prefix + '_degree': self.degree}
+		for streams, per_stream in self._throughput.items():
+			stats['%s_%d_stream_bytes_per_second' % (prefix, streams)] = int(per_stream)
+		return stats
+
+
+class _Flight(object):
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	"""
+	Collapses concurrent calls for the same key into one.
+
+	The first caller for a key runs the function; callers arriving while it
+	is in flight wait for it and get its result, or its exception, instead
+	of repeating the work. Nothing is remembered once the call returns.
+	"""
+
+	def __init__(self):
+		self.calls = 0
+		self.suppressed = 0
+		self._flights = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, function):
+		"""
+		Returns (result, shared) where shared is True if the result came from
+		a call made by another thread.
+		"""
+		with self._lock:
+			flight = self._flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._flights[key] = _Flight()
+				self.calls += 1
+			else:
+				self.suppressed += 1
+		if not leader:
+			flight.done.wait()
+			if flight.error is not None:
+				raise flight.error
+			return flight.result, True
+		try:
+			flight.result = function()
+		except Exception as e:
+			flight.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._flights[key]
+			flight.done.set()
+		return flight.result, False
+
+	def stats(self, prefix):
+		return {
+			prefix + '_calls': self.calls,
+			prefix + '_suppressed': self.suppressed,
+			prefix + '_in_flight': len(self._flights),
+		}
+
+
+class _Range(object):
+
+	def __init__(self, start, end):
+		self.start = start
+		self.end = end
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class RangeCoalescer(object):
+	"""
+	Merges ranged downloads of the same blob that are requested at about
+	the same time into fewer, larger requests.
+
+	The first fetch() for a key opens a batch and waits ``window`` seconds
+	for others to join it. The batch's ranges are then sorted and merged
+	wherever the gap between them is at most ``max_gap`` bytes and the
+	merged range stays within ``max_bytes``; every merged range is
+	downloaded with one ``fetch_range(key, start, end)`` and split back out
+	to its callers. A failed download raises in each of its callers.
+	"""
+
+	def __init__(self, fetch_range, window, max_gap=0, max_bytes=16 * 1024 * 1024):
+		self.window = window
+		self.max_gap = max_gap
+		self.max_bytes = max_bytes
+		self.requests = 0
+		self.fetches = 0
+		self.gap_bytes = 0
+		self._fetch_range = fetch_range
+		self._batches = {}
+		self._lock = threading.Lock()
+
+	def fetch(self, key, start, end):
+		"""Returns bytes ``start`` to ``end`` inclusive of ``key``."""
+		request = _Range(start, end)
+		with self._lock:
+			batch = self._batches.get(key)
+			leader = batch is None
+			if leader:
+				batch = self._batches[key] = []
+			batch.append(request)
+			self.requests += 1
+		if leader:
+			sleep(self.window)
+			with self._lock:
+				del self._batches[key]
+			self._run(key, batch)
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.result
+
+	def _groups(self, batch):
+		groups = []
+		for request in sorted(batch, key=lambda request: request.start):
+			if groups:
+				group = groups[-1]
+				start, end = group[0].start, max(r.end for r in group)
+				if (request.start - end - 1 <= self.max_gap and
+						max(end, request.end) - start + 1 <= self.max_bytes):
+					group.append(request)
+					continue
+			groups.append([request])
+		return groups
+
+	def _run(self, key, batch):
+		for group in self._groups(batch):
+			start, end = group[0].start, max(request.end for request in group)
+			try:
+				data = self._fetch_range(key, start, end)
+				for request in group:
+					request.result = data[request.start - start:request.end - start + 1]
+			except Exception as e:
+				for request in group:
+					request.error = e
+			finally:
+				self.fetches += 1
+				self.gap_bytes += max(0, end - start + 1 - sum(
+					request.end - request.start + 1 for request in group))
+				for request in group:
+					request.done.set()
+
+	def stats(self, prefix):
+		return {
+			prefix + '_requests': self.requests,
+			prefix + '_fetches': self.fetches,
+			prefix + '_gap_bytes': self.gap_bytes,
+		}
+
+
+def fetch_parallel(fetch_range, start, end, parallelism, min_range=1024 * 1024):
+	"""
+	Downloads bytes ``start`` to ``end`` inclusive by splitting them into up
+	to ``parallelism.degree`` ranges of at least ``min_range`` bytes that are
+	fetched concurrently with ``fetch_range(start, end)``. The pieces are
+	joined in order and the observed throughput is reported back to
+	``parallelism``.
+
+	The first range is fetched on the calling thread. An error in any range
+	is raised once all of them have finished.
+	"""
+	length = end - start + 1
+	streams = max(1, min(parallelism.degree, length // min_range))
+	step = (length + streams - 1) // streams
+	ranges = [(offset, min(offset + step, end + 1) - 1)
+			  for offset in range(start, end + 1, step)]
+	results = [None] * len(ranges)
+	errors = []
+
+	def fetch(i):
+		try:
+			results[i] = fetch_range(*ranges[i])
+		except Exception as e:
+			errors.append(e)
+
+	began = time()
+	threads = [threading.Thread(target=fetch, args=(i,)) for i in range(1, len(ranges))]
+	for thread in threads:
+		thread.start()
+	fetch(0)
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+	parallelism.record(len(ranges), length, time() - began)
+	return b''.join(results)
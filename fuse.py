@@ -555,6 +555,16 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
+        if getattr(self.operations, 'read_into', None):
+            # let the filesystem write straight into the kernel's buffer
+            view = memoryview((c_ubyte * size).from_address(
+                cast(buf, c_void_p).value))
+            if hasattr(view, 'cast'):
+                view = view.cast('B')
+
+            return self.operations('read_into', path.decode(self.encoding),
+                                   view, offset, fh)
+
         ret = self.operations('read', path.decode(self.encoding), size,
                                       offset, fh)
 
@@ -569,13 +579,23 @@ class FUSE(object):
         return retsize
 
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
-
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
+        if getattr(self.operations, 'write_from', None):
+            # expose the kernel's buffer without copying it into a string
+            view = memoryview((c_ubyte * size).from_address(
+                cast(buf, c_void_p).value))
+            if hasattr(view, 'cast'):
+                view = view.cast('B')
+
+            return self.operations('write_from', path.decode(self.encoding),
+                                   view, offset, fh)
+
+        data = string_at(buf, size)
+
         return self.operations('write', path.decode(self.encoding), data,
                                         offset, fh)
 
@@ -665,20 +685,26 @@ class FUSE(object):
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
-                                               fip.contents.fh):
+        args = [path.decode(self.encoding), fip.contents.fh]
+
+        # Only filesystems that hand out non-zero offsets are asked to resume
+        # a listing, so the two argument form keeps working for everyone else
+        if offset:
+            args.append(offset)
+
+        for item in self.operations('readdir', *args):
 
             if isinstance(item, basestring):
-                name, st, offset = item, None, 0
+                name, st, next_offset = item, None, 0
             else:
-                name, attrs, offset = item
+                name, attrs, next_offset = item
                 if attrs:
                     st = c_stat()
                     set_st_attrs(st, attrs)
                 else:
                     st = None
 
-            if filler(buf, name.encode(self.encoding), st, offset) != 0:
+            if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
                 break
 
         return 0
@@ -878,10 +904,20 @@ class Operations(object):
 
         raise FuseOSError(EIO)
 
+    # read_into(self, path, buf, offset, fh) may be defined instead to copy
+    # the data directly into buf, a writable memoryview of the kernel's
+    # buffer, and return the number of bytes written. It is used in
+    # preference to read, which costs an extra copy and allocation.
+    read_into = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
         tuples. attrs is a dict as in getattr.
+
+        When non-zero offsets are returned, offset is that of the next entry
+        and readdir may be called again as readdir(path, fh, offset) to resume
+        the listing from there.
         '''
 
         return ['.', '..']
@@ -937,6 +973,13 @@ class Operations(object):
     def write(self, path, data, offset, fh):
         raise FuseOSError(EROFS)
 
+    # write_from(self, path, buf, offset, fh) may be defined instead to take
+    # the data as a memoryview of the kernel's buffer rather than a string
+    # copied out of it. buf is only valid until write_from returns, so it
+    # must be consumed or copied before then. It is used in preference to
+    # write.
+    write_from = None
+
 
 class LoggingMixIn:
     log = logging.getLogger('fuse.log-mixin')
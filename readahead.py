@@ -0,0 +1,216 @@
+"""
+@name readahead.py
+
+Access pattern detection and background prefetching of blob chunks.
+"""
+import threading
+
+from collections import OrderedDict
+
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+
+
+class _Stream(object):
+	"""One sequential cursor within a file."""
+
+	def __init__(self, offset):
+		self.start = offset
+		self.next_offset = offset
+		self.last_index = None
+		self.window = 0
+
+
+class ReadAhead(object):
+	"""
+	Access pattern detector for one open file.
+
+	Up to ``max_streams`` sequential streams are followed at once, so reads
+	interleaving several cursors over one handle do not look random. A read
+	that starts where a stream's previous read ended continues that stream;
+	each time the stream moves into a new chunk its read-ahead window
+	doubles, up to ``max_window`` chunks. Any other read is a seek and
+	starts a new stream in place of the least recently used one.
+
+	The positions of the last ``history`` seeks are kept as well. Once they
+	are evenly spaced, e.g. a reader taking one column chunk out of every
+	row group, the runs expected at the next ``stride_depth`` strides are
+	prefetched as well.
+
+	Every predicted chunk counts as useful once it is read. After
+	``min_predictions`` predictions, a handle on which fewer than
+	``min_accuracy`` of them were useful stops prefetching for good.
+	"""
+
+	def __init__(self, chunk_size, max_window=8, max_streams=4, history=4, stride_depth=2,
+				 min_accuracy=0.25, min_predictions=32):
+		self.chunk_size = chunk_size
+		self.max_window = max_window
+		self.max_streams = max_streams
+		self.history = history
+		self.stride_depth = stride_depth
+		self.min_accuracy = min_accuracy
+		self.min_predictions = min_predictions
+		self.enabled = True
+		self.seeks = 0
+		self.strides = 0
+		self.predicted = 0
+		self.useful = 0
+		self._streams = [_Stream(0)]
+		self._seeks = []
+		self._pending = OrderedDict()
+
+	@property
+	def window(self):
+		return self._streams[-1].window
+
+	@property
+	def streaming(self):
+		"""
+		True for a long sequential scan, i.e. once the window of the current
+		stream is fully open, and for a file being read in order from its
+		start.
+		"""
+		stream = self._streams[-1]
+		return stream.window == self.max_window or (stream.start == 0 and stream.window > 0)
+
+	def access(self, offset, length):
+		"""
+		Records a read of ``length`` bytes at ``offset`` and returns the
+		indices of the chunks that should be prefetched.
+		"""
+		first, index = offset // self.chunk_size, (offset + length - 1) // self.chunk_size
+		for i in range(first, index + 1):
+			if self._pending.pop(i, None) is not None:
+				self.useful += 1
+		streams = [s for s in self._streams if s.next_offset == offset]
+		indexes = []
+		if streams:
+			stream = streams[0]
+			self._streams.remove(stream)
+			if index != stream.last_index:
+				stream.window = min(max(stream.window * 2, 1), self.max_window)
+			indexes.extend(range(index + 1, index + 1 + stream.window))
+		else:
+			self.seeks += 1
+			previous = self._streams[-1]
+			stream = _Stream(offset)
+			indexes.extend(self._strided(offset, max(previous.next_offset - previous.start, length)))
+		self._streams.append(stream)
+		del self._streams[:-self.max_streams]
+		stream.next_offset = offset + length
+		stream.last_index = index
+		return self._predict(indexes)
+
+	def _strided(self, offset, run):
+		"""
+		Returns the chunks of the runs of ``run`` bytes expected at the next
+		strides if the recent seeks, ending with one to ``offset``, are
+		evenly spaced.
+		"""
+		self._seeks.append(offset)
+		del self._seeks[:-self.history]
+		deltas = set(b - a for a, b in zip(self._seeks, self._seeks[1:]))
+		if len(self._seeks) < self.history or len(deltas) != 1:
+			return []
+		stride = deltas.pop()
+		if abs(stride) < run:
+			return []
+		self.strides += 1
+		indexes = []
+		for k in range(1, self.stride_depth + 1):
+			start = offset + k * stride
+			if start < 0:
+				break
+			end = start + min(run, self.max_window * self.chunk_size)
+			indexes.extend(range(start // self.chunk_size, (end - 1) // self.chunk_size + 1))
+		return indexes
+
+	def _predict(self, indexes):
+		if self.enabled and self.predicted >= self.min_predictions:
+			if self.useful < self.min_accuracy * self.predicted:
+				self.enabled = False
+				self._pending.clear()
+		if not self.enabled:
+			return []
+		predicted = []
+		for index in indexes:
+			if index >= 0 and index not in self._pending:
+				self._pending[index] = True
+				predicted.append(index)
+		self.predicted += len(predicted)
+		while len(self._pending) > self.max_window * self.max_streams * 4:
+			self._pending.popitem(last=False)
+		return predicted
+
+	def stats(self, prefix):
+		return {
+			prefix + '_seeks': self.seeks,
+			prefix + '_strides': self.strides,
+			prefix + '_predicted_chunks': self.predicted,
+			prefix + '_useful_chunks': self.useful,
+		}
+
+
+class Prefetcher(object):
+	"""
+	Worker threads that run chunk fetches in the background.
+
+	Each job is scheduled under a key; a key that is already queued or being
+	fetched is not scheduled twice.
+	"""
+
+	def __init__(self, workers=4):
+		self.workers = workers
+		self.scheduled = 0
+		self.failed = 0
+		self._queue = Queue()
+		self._pending = set()
+		self._lock = threading.Lock()
+		self._threads = []
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			key, job = item
+			try:
+				job()
+			except Exception:
+				# a failed prefetch only costs the reader a foreground fetch
+				self.failed += 1
+			finally:
+				with self._lock:
+					self._pending.discard(key)
+
+	def _start(self):
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._run, name='blobfs-prefetch-%d' % i)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def schedule(self, key, job):
+		with self._lock:
+			if key in self._pending:
+				return False
+			if not self._threads:
+				self._start()
+			self._pending.add(key)
+			self.scheduled += 1
+		self._queue.put((key, job))
+		return True
+
+	def stop(self):
+		for thread in self._threads:
+			self._queue.put(None)
+
+	def stats(self, prefix):
+		return {
+			prefix + '_scheduled': self.scheduled,
+			prefix + '_failed': self.failed,
+			prefix + '_queued': self._queue.qsize(),
+		}
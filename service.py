@@ -0,0 +1,57 @@
+"""
+@name service.py
+
+Blob service clients shared by every operation of a mount.
+"""
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from azure.storage.blob import AppendBlobService, BlockBlobService, PageBlobService
+
+
+class ServicePool(object):
+	"""
+	Hands out blob service clients that share one pool of kept-alive HTTPS
+	connections of at most ``pool_size`` connections.
+
+	requests sessions are not safe to share between threads, so every thread
+	gets its own session and clients; all sessions are mounted on the same
+	adapter and therefore reuse each other's connections.
+	"""
+
+	def __init__(self, pool_size=16, **credentials):
+		self.credentials = credentials
+		self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self._local = threading.local()
+
+	def _session(self):
+		session = getattr(self._local, 'session', None)
+		if session is None:
+			session = Session()
+			session.mount('https://', self._adapter)
+			session.mount('http://', self._adapter)
+			self._local.session = session
+		return session
+
+	def _client(self, name, service_class):
+		client = getattr(self._local, name, None)
+		if client is None:
+			client = service_class(request_session=self._session(), **self.credentials)
+			setattr(self._local, name, client)
+		return client
+
+	@property
+	def block(self):
+		return self._client('block', BlockBlobService)
+
+	@property
+	def append(self):
+		return self._client('append', AppendBlobService)
+
+	@property
+	def page(self):
+		return self._client('page', PageBlobService)
+
+	def close(self):
+		self._adapter.close()
@@ -0,0 +1,129 @@
+"""
+@name test_blobfs.py
+
+Tests of the Passthrough file system against an in-memory blob service.
+"""
+import errno
+import stat
+import unittest
+
+from azure.common import AzureMissingResourceHttpError
+
+from blobfs import Passthrough
+
+
+class Listing(object):
+	"""
+	Mirrors the ListGenerator list_blobs returns: iterable, never falsy.
+	"""
+	def __init__(self, items, next_marker=None):
+		self.items = items
+		self.next_marker = next_marker
+
+	def __iter__(self):
+		return iter(self.items)
+
+
+class Properties(object):
+	def __init__(self, content_length):
+		self.content_length = content_length
+		self.etag = '"0x1"'
+		self.last_modified = None
+		self.blob_type = 'BlockBlob'
+
+
+class Blob(object):
+	def __init__(self, name, content_length=1):
+		self.name = name
+		self.properties = Properties(content_length)
+
+
+class FakeService(object):
+	"""
+	A container 'c' holding the given blob names.
+	"""
+	def __init__(self, names):
+		self.names = sorted(names)
+		self.listings = 0
+
+	def get_blob_properties(self, containername, blobname, **kwargs):
+		if blobname not in self.names:
+			raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+		return Blob(blobname)
+
+	def list_blobs(self, containername, prefix=None, num_results=None, marker=None, **kwargs):
+		self.listings += 1
+		names = [name for name in self.names if name.startswith(prefix or '')]
+		start = int(marker or 0)
+		page = names[start:start + (num_results or 5000)]
+		end = start + len(page)
+		return Listing([Blob(name) for name in page], str(end) if end < len(names) else None)
+
+	def list_containers(self):
+		return [Blob('c')]
+
+
+class FakePassthrough(Passthrough):
+	fake = None
+
+	@property
+	def service(self):
+		return self.fake
+
+
+class LookupTest(unittest.TestCase):
+
+	def setUp(self):
+		self.fs = FakePassthrough('/tmp')
+		self.fs.fake = FakeService(['file', 'dir/child'])
+
+	def test_missing_blob_is_enoent(self):
+		with self.assertRaises(OSError) as raised:
+			self.fs.getattr('/c/nosuchfile')
+		self.assertEqual(raised.exception.errno, errno.ENOENT)
+
+	def test_prefix_of_blobs_is_a_directory(self):
+		self.assertTrue(stat.S_ISDIR(self.fs.getattr('/c/dir')['st_mode']))
+
+	def test_blob_is_a_file(self):
+		self.assertTrue(stat.S_ISREG(self.fs.getattr('/c/file')['st_mode']))
+
+
+class ReaddirTest(unittest.TestCase):
+
+	def setUp(self):
+		self.fs = FakePassthrough('/tmp')
+		self.fs.fake = FakeService(['f%04d' % i for i in range(1000)])
+		self.fs.readdir_page_size = 100
+
+	def read(self, fh, per_call):
+		"""
+		Reads a directory the way libfuse does, resuming at the last offset
+		every time the filler has taken per_call entries.
+		"""
+		names = []
+		offset = 0
+		while True:
+			taken = 0
+			for name, attrs, offset in self.fs.readdir('/c', fh, offset):
+				names.append(name)
+				taken += 1
+				if taken == per_call:
+					break
+			if taken < per_call:
+				return names
+
+	def test_each_page_is_listed_once(self):
+		names = self.read(self.fs.opendir('/c'), 70)
+		self.assertEqual(names, ['.', '..'] + self.fs.fake.names)
+		self.assertEqual(self.fs.fake.listings, 10)
+
+	def test_rewinding_lists_again(self):
+		fh = self.fs.opendir('/c')
+		self.read(fh, 70)
+		self.assertEqual(len(self.read(fh, 70)), 1002)
+		self.assertEqual(self.fs.fake.listings, 20)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,70 @@
+"""
+@name test_download.py
+
+Tests of the adaptive parallel range downloads.
+"""
+import unittest
+
+from time import sleep
+
+from download import AdaptiveParallelism, fetch_parallel
+
+MiB = 1024 * 1024
+CHUNK = 4 * MiB
+
+
+class AdaptiveParallelismTest(unittest.TestCase):
+
+	def parallelism(self):
+		# as blobfs builds it with the default chunk and range sizes
+		return AdaptiveParallelism(max_degree=min(8, CHUNK // MiB))
+
+	def fetch(self, parallelism, per_stream):
+		"""
+		Downloads one chunk with fetch_parallel from a simulated link where
+		each of n concurrent streams gets per_stream(n) bytes per second,
+		and returns how many streams were used.
+		"""
+		ranges = []
+		streams = min(parallelism.degree, CHUNK // MiB)
+
+		def fetch_range(start, end):
+			ranges.append((start, end))
+			sleep((end - start + 1) / per_stream(streams))
+			return b''
+
+		fetch_parallel(fetch_range, 0, CHUNK - 1, parallelism, MiB)
+		self.assertEqual(len(ranges), streams)
+		return streams
+
+	def test_degree_is_capped_by_the_ranges_per_chunk(self):
+		parallelism = self.parallelism()
+		used = [self.fetch(parallelism, lambda n: 100.0 * MiB) for i in range(10)]
+		self.assertEqual(parallelism.max_degree, 4)
+		self.assertEqual(max(used), 4)
+		self.assertEqual(parallelism.degree, 4)
+
+	def test_steps_back_down_once_the_link_saturates(self):
+		parallelism = self.parallelism()
+		for i in range(10):
+			self.fetch(parallelism, lambda n: 100.0 * MiB)
+		# aggregate throughput is capped at 200 MiB/s from now on
+		used = [self.fetch(parallelism, lambda n: 200.0 * MiB / n) for i in range(20)]
+		self.assertLess(min(used[-5:]), 4)
+
+	def test_judges_the_streams_actually_used(self):
+		parallelism = AdaptiveParallelism(max_degree=8, initial=6)
+		parallelism.record(2, 2 * MiB, 1.0)
+		parallelism.record(3, 3 * MiB, 2.0)
+		self.assertEqual(parallelism.degree, 2)
+
+	def test_fetch_parallel_joins_ranges_in_order(self):
+		data = bytes(bytearray(range(256))) * (CHUNK // 256)
+		parallelism = self.parallelism()
+		parallelism.degree = 4
+		self.assertEqual(fetch_parallel(lambda start, end: data[start:end + 1],
+										0, CHUNK - 1, parallelism, MiB), data)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,648 @@
+"""
+@name upload.py
+
+Write-back of files written through the mount as staged blob blocks.
+"""
+import bisect
+import errno
+import threading
+import uuid
+
+from time import time
+
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+
+from azure.storage.blob import BlobBlock
+from azure.storage.blob.models import BlobBlockState, BlockListType
+
+
+class UploadStats(object):
+	"""Upload counters shared by every writer of a mount."""
+
+	def __init__(self):
+		self.blocks = 0
+		self.bytes = 0
+		self.commits = 0
+		self.reused = 0
+		self.failures = 0
+		self.block_seconds = 0.0
+		self.commit_seconds = 0.0
+		self._lock = threading.Lock()
+
+	def block(self, nbytes, seconds):
+		with self._lock:
+			self.blocks += 1
+			self.bytes += nbytes
+			self.block_seconds += seconds
+
+	def commit(self, seconds, reused):
+		with self._lock:
+			self.commits += 1
+			self.reused += reused
+			self.commit_seconds += seconds
+
+	def failure(self):
+		with self._lock:
+			self.failures += 1
+
+	def stats(self, prefix):
+		return {
+			prefix + '_blocks': self.blocks,
+			prefix + '_bytes': self.bytes,
+			prefix + '_commits': self.commits,
+			prefix + '_reused_blocks': self.reused,
+			prefix + '_failures': self.failures,
+			prefix + '_block_latency_ms': int(1000 * self.block_seconds / self.blocks) if self.blocks else 0,
+			prefix + '_commit_latency_ms': int(1000 * self.commit_seconds / self.commits) if self.commits else 0,
+		}
+
+
+class _Upload(object):
+
+	def __init__(self, nbytes, job):
+		self.nbytes = nbytes
+		self.job = job
+		self.done = threading.Event()
+		self.error = None
+
+
+class UploadPool(object):
+	"""
+	Worker threads that upload blocks while the writer keeps producing data.
+
+	At most ``max_bytes`` of blocks are queued or being uploaded at once;
+	submit() blocks until enough of them have finished, which pushes back
+	on whoever is writing faster than the blocks can be uploaded. A single
+	block larger than the cap is let through on its own.
+	"""
+
+	def __init__(self, workers=8, max_bytes=64 * 1024 * 1024):
+		self.workers = workers
+		self.max_bytes = max_bytes
+		self.in_flight = 0
+		self.waits = 0
+		self._queue = Queue()
+		self._space = threading.Condition()
+		self._threads = []
+
+	def _run(self):
+		while True:
+			upload = self._queue.get()
+			if upload is None:
+				break
+			try:
+				upload.job()
+			except Exception as e:
+				upload.error = e
+			finally:
+				with self._space:
+					self.in_flight -= upload.nbytes
+					self._space.notify_all()
+				upload.done.set()
+
+	def _start(self):
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._run, name='blobfs-upload-%d' % i)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, nbytes, job):
+		"""Queues ``job`` uploading ``nbytes`` bytes and returns its _Upload."""
+		upload = _Upload(nbytes, job)
+		with self._space:
+			if not self._threads:
+				self._start()
+			if self.in_flight and self.in_flight + nbytes > self.max_bytes:
+				self.waits += 1
+				while self.in_flight and self.in_flight + nbytes > self.max_bytes:
+					self._space.wait()
+			self.in_flight += nbytes
+		self._queue.put(upload)
+		return upload
+
+	def stop(self):
+		for thread in self._threads:
+			self._queue.put(None)
+
+	def stats(self, prefix):
+		return {
+			prefix + '_in_flight_bytes': self.in_flight,
+			prefix + '_backpressure_waits': self.waits,
+		}
+
+
+class _Block(object):
+	"""
+	One block of the blob being written.
+
+	data holds the block's bytes while it is dirty. Once it has been
+	uploaded, data is None and id names the block on the server; committed
+	tells whether it is part of the committed blob yet. A block with
+	neither data nor id still has its bytes in the committed blob at the
+	same offset.
+	"""
+
+	def __init__(self, length, id=None, data=None, committed=False):
+		self.length = length
+		self.id = id
+		self.data = data
+		self.committed = committed
+
+
+class BlockWriter(object):
+	"""
+	Write-back buffer of one block blob.
+
+	The blob is kept as a list of blocks. Writes go to in-memory copies of
+	the blocks they touch; a dirty block is handed to the UploadPool for
+	put_block as soon as a write has moved past it, so a file written
+	sequentially only holds the block at its end, and those still being
+	uploaded, in memory. flush() uploads the remaining dirty blocks, waits
+	for every upload and commits the list of all blocks in order with
+	put_block_list. A block that failed to upload is dirty again and the
+	failure is raised from the next write or flush.
+
+	A block that has to be modified after it was uploaded is read back from
+	the blob, committing the staged blocks first if necessary. Appending
+	to the blob adds new blocks of ``block_size`` bytes.
+
+	For an existing blob, load_blocks() takes the layout from its committed
+	block list. Only the blocks that are written to are then read back and
+	uploaded again; the commit reuses the ids of all the others, so a small
+	edit of a large blob moves a block's worth of data.
+	"""
+
+	blob_type = 'BlockBlob'
+
+	def __init__(self, services, pool, container, blob, block_size, stats, size=0, etag=None):
+		self.services = services
+		self.pool = pool
+		self.container = container
+		self.blob = blob
+		self.block_size = block_size
+		self.stats = stats
+		self.size = 0
+		self.etag = etag
+		self.last_modified = None
+		self.changed = False
+		self._blocks = []
+		self._starts = []
+		self._dirty = set()
+		self._uploads = []
+		self._ids = set()
+		self._id_length = 32
+		self._lock = threading.RLock()
+		while self.size < size:
+			self._append(_Block(min(block_size, size - self.size)))
+
+	@property
+	def dirty_bytes(self):
+		return sum(self._blocks[index].length for index in self._dirty)
+
+	def _append(self, block):
+		self._starts.append(self.size)
+		self._blocks.append(block)
+		self.size += block.length
+
+	def _find(self, offset):
+		return bisect.bisect_right(self._starts, offset) - 1
+
+	def _new_id(self):
+		# every block id of a blob must have the same length
+		while True:
+			block_id = (uuid.uuid4().hex * (self._id_length // 32 + 1))[:self._id_length]
+			if block_id not in self._ids:
+				self._ids.add(block_id)
+				return block_id
+
+	def load_blocks(self):
+		"""
+		Replaces the layout with the blob's committed block list. Returns
+		False, keeping the layout, for a blob that was not uploaded as
+		blocks or whose block ids are too short to add unique ones to.
+		"""
+		with self._lock:
+			blocks = self.services.block.get_block_list(
+				self.container, self.blob, block_list_type=BlockListType.Committed).committed_blocks
+			lengths = set(len(block.id) for block in blocks)
+			if (not blocks or len(lengths) != 1 or min(lengths) < 8 or
+					sum(block.size for block in blocks) != self.size):
+				return False
+			del self._blocks[:], self._starts[:]
+			self._dirty.clear()
+			self.size = 0
+			for block in blocks:
+				self._append(_Block(block.size, id=block.id, committed=True))
+			self._ids = set(block.id for block in blocks)
+			self._id_length = lengths.pop()
+			return True
+
+	def _extend(self, size):
+		"""Grows the blob with zeros to ``size`` bytes."""
+		if self._blocks and self._blocks[-1].data is not None:
+			last = self._blocks[-1]
+			grow = min(self.block_size - last.length, size - self.size)
+			if grow > 0:
+				last.data.extend(bytearray(grow))
+				last.length += grow
+				self.size += grow
+		while self.size < size:
+			length = min(self.block_size, size - self.size)
+			self._dirty.add(len(self._blocks))
+			self._append(_Block(length, data=bytearray(length)))
+
+	def _load(self, index):
+		"""Makes the block dirty, reading back its bytes if needed."""
+		block = self._blocks[index]
+		if block.data is None:
+			if block.id is not None and not block.committed:
+				# uncommitted blocks cannot be read back
+				self._commit()
+			start = self._starts[index]
+			blob = self.services.block.get_blob_to_bytes(
+				self.container, self.blob, start_range=start,
+				end_range=start + block.length - 1, max_connections=1, if_match=self.etag)
+			block.data = bytearray(blob.content)
+		self._dirty.add(index)
+		return block
+
+	def _upload(self, index):
+		block = self._blocks[index]
+		block_id = self._new_id()
+		data = block.data
+
+		def put_block():
+			began = time()
+			try:
+				self.services.block.put_block(self.container, self.blob, bytes(data), block_id)
+			except Exception:
+				self.stats.failure()
+				raise
+			self.stats.block(len(data), time() - began)
+
+		upload = self.pool.submit(len(data), put_block)
+		upload.block, upload.data = block, data
+		self._uploads.append(upload)
+		block.id = block_id
+		block.data = None
+		block.committed = False
+		self._dirty.discard(index)
+
+	def _reap(self, wait=False):
+		"""
+		Forgets finished uploads, or waits for all of them, and raises the
+		error of any that failed after making its block dirty again.
+		"""
+		error = None
+		for upload in list(self._uploads):
+			if wait:
+				upload.done.wait()
+			if not upload.done.is_set():
+				continue
+			self._uploads.remove(upload)
+			if upload.error is not None:
+				error = error or upload.error
+				if upload.block in self._blocks and upload.block.data is None:
+					upload.block.id = None
+					upload.block.data = upload.data
+					self._dirty.add(self._blocks.index(upload.block))
+		if error is not None:
+			raise error
+
+	def _commit(self):
+		for index in sorted(self._dirty):
+			self._upload(index)
+		for index, block in enumerate(self._blocks):
+			if block.id is None:
+				# still only in the committed blob, under no known block id
+				self._load(index)
+				self._upload(index)
+		self._reap(wait=True)
+		reused = sum(1 for block in self._blocks if block.committed)
+		began = time()
+		try:
+			properties = self.services.block.put_block_list(
+				self.container, self.blob,
+				[BlobBlock(id=block.id, state=BlobBlockState.Committed if block.committed
+						   else BlobBlockState.Uncommitted) for block in self._blocks],
+				if_match=self.etag)
+		except Exception:
+			self.stats.failure()
+			raise
+		self.stats.commit(time() - began, reused)
+		self.etag = properties.etag
+		self.last_modified = properties.last_modified
+		for block in self._blocks:
+			block.committed = True
+		self._ids = set(block.id for block in self._blocks)
+		self.changed = False
+
+	def create(self):
+		"""Replaces the blob with an empty one right away."""
+		with self._lock:
+			self.etag = None
+			del self._blocks[:], self._starts[:]
+			self._dirty.clear()
+			self.size = 0
+			self._commit()
+
+	def write(self, data, offset):
+		"""
+		Writes ``data`` at ``offset``. Data is copied, so it may be a view of
+		a buffer that is reused once write returns.
+		"""
+		data = memoryview(data)
+		end = offset + len(data)
+		with self._lock:
+			self._extend(end)
+			index = self._find(offset)
+			position = offset
+			while position < end:
+				block = self._load(index)
+				start = self._starts[index]
+				low, high = position - start, min(end - start, block.length)
+				block.data[low:high] = data[position - offset:position - offset + high - low]
+				position = start + high
+				index += 1
+			self.changed = True
+			last = self._find(end - 1)
+			for index in sorted(self._dirty):
+				if index < last:
+					self._upload(index)
+			self._reap()
+		return len(data)
+
+	def truncate(self, length):
+		with self._lock:
+			if length >= self.size:
+				self._extend(length)
+			else:
+				index = self._find(length)
+				if self._starts[index] < length:
+					block = self._load(index)
+					del block.data[length - self._starts[index]:]
+					block.length = len(block.data)
+					index += 1
+				del self._blocks[index:], self._starts[index:]
+				self._dirty = set(i for i in self._dirty if i < index)
+				self.size = length
+			self.changed = True
+
+	def flush(self):
+		"""
+		Uploads what is still dirty and commits the block list. Returns True
+		if anything had changed.
+		"""
+		with self._lock:
+			if not self.changed:
+				return False
+			self._commit()
+			return True
+
+
+class AppendWriter(object):
+	"""
+	Write-back buffer of one append blob.
+
+	Writes must extend the blob; bytes not yet appended may still be
+	rewritten. They are buffered and sent with append_block, at most
+	``max_block`` bytes per request, whenever that much is pending and on
+	flush(), so every flush costs requests in proportion to the new bytes
+	only. appendpos_condition makes Azure refuse an append if the blob grew
+	behind our back.
+	"""
+
+	blob_type = 'AppendBlob'
+
+	def __init__(self, services, container, blob, stats, size=0, etag=None,
+				 max_block=4 * 1024 * 1024):
+		self.services = services
+		self.container = container
+		self.blob = blob
+		self.stats = stats
+		self.max_block = max_block
+		self.etag = etag
+		self.last_modified = None
+		self.changed = False
+		self._appended = size
+		self._buffer = bytearray()
+		self._lock = threading.RLock()
+
+	@property
+	def size(self):
+		return self._appended + len(self._buffer)
+
+	@property
+	def dirty_bytes(self):
+		return len(self._buffer)
+
+	def _append(self, length):
+		block = bytes(self._buffer[:length])
+		began = time()
+		try:
+			properties = self.services.append.append_block(
+				self.container, self.blob, block, appendpos_condition=self._appended)
+		except Exception:
+			self.stats.failure()
+			raise
+		self.stats.block(length, time() - began)
+		del self._buffer[:length]
+		self._appended += length
+		self.etag = properties.etag
+		self.last_modified = properties.last_modified
+
+	def create(self):
+		"""Replaces the blob with an empty append blob right away."""
+		with self._lock:
+			properties = self.services.append.create_blob(self.container, self.blob)
+			self.etag = properties.etag
+			self.last_modified = properties.last_modified
+			self._appended = 0
+			del self._buffer[:]
+			self.changed = False
+
+	def write(self, data, offset):
+		data = memoryview(data)
+		with self._lock:
+			if offset < self._appended:
+				raise OSError(errno.EOPNOTSUPP, 'append blobs can only be appended to')
+			if offset > self.size:
+				self._buffer.extend(bytearray(offset - self.size))
+			start = offset - self._appended
+			self._buffer[start:start + len(data)] = data
+			self.changed = True
+			while len(self._buffer) >= self.max_block:
+				self._append(self.max_block)
+		return len(data)
+
+	def truncate(self, length):
+		with self._lock:
+			if length == 0:
+				self.create()
+				self.changed = True
+			elif length < self._appended:
+				raise OSError(errno.EOPNOTSUPP, 'append blobs cannot be shortened')
+			elif length < self.size:
+				del self._buffer[length - self._appended:]
+			elif length > self.size:
+				self._buffer.extend(bytearray(length - self.size))
+				self.changed = True
+
+	def flush(self):
+		"""
+		Appends whatever is buffered. Returns True if anything had changed.
+		"""
+		with self._lock:
+			if not self.changed:
+				return False
+			while self._buffer:
+				self._append(min(len(self._buffer), self.max_block))
+			self.changed = False
+			return True
+
+
+class PageWriter(object):
+	"""
+	Write-back buffer of one page blob, for files written at random offsets
+	such as disk images and databases.
+
+	Page blobs are made of 512-byte pages, so the file's size is always
+	rounded up to a multiple of 512. Written pages are kept until flush(),
+	or until ``max_dirty`` bytes of them are pending, and then sent with
+	update_page, one request per run of consecutive pages of at most
+	``max_run`` bytes; a page only partly written is read back first.
+	Growing the file resizes the blob before the pages are written, and
+	truncate() shrinks it with resize_blob right away.
+	"""
+
+	blob_type = 'PageBlob'
+	page_size = 512
+
+	def __init__(self, services, container, blob, stats, size=0, etag=None,
+				 max_run=4 * 1024 * 1024, max_dirty=64 * 1024 * 1024):
+		self.services = services
+		self.container = container
+		self.blob = blob
+		self.stats = stats
+		self.max_run = max_run
+		self.max_dirty = max_dirty
+		self.size = size
+		self.etag = etag
+		self.last_modified = None
+		self.changed = False
+		self._blob_size = size
+		self._pages = {}
+		self._lock = threading.RLock()
+
+	@property
+	def dirty_bytes(self):
+		return len(self._pages) * self.page_size
+
+	def _round(self, length):
+		return (length + self.page_size - 1) // self.page_size * self.page_size
+
+	def _updated(self, properties):
+		self.etag = properties.etag
+		self.last_modified = properties.last_modified
+
+	def _page(self, index):
+		page = self._pages.get(index)
+		if page is None:
+			start = index * self.page_size
+			if start < self._blob_size:
+				page = bytearray(self.services.page.get_blob_to_bytes(
+					self.container, self.blob, start_range=start,
+					end_range=start + self.page_size - 1, max_connections=1,
+					if_match=self.etag).content)
+			else:
+				page = bytearray(self.page_size)
+			self._pages[index] = page
+		return page
+
+	def _resize(self, size):
+		self._updated(self.services.page.resize_blob(
+			self.container, self.blob, size, if_match=self.etag))
+		self._blob_size = size
+
+	def _write_pages(self):
+		if self.size > self._blob_size:
+			self._resize(self.size)
+		pages = sorted(self._pages)
+		run = []
+		for i, index in enumerate(pages):
+			run.append(index)
+			if (i + 1 == len(pages) or pages[i + 1] != index + 1 or
+					len(run) * self.page_size >= self.max_run):
+				start = run[0] * self.page_size
+				data = b''.join(bytes(self._pages[index]) for index in run)
+				began = time()
+				try:
+					self._updated(self.services.page.update_page(
+						self.container, self.blob, data, start, start + len(data) - 1,
+						if_match=self.etag))
+				except Exception:
+					self.stats.failure()
+					raise
+				self.stats.block(len(data), time() - began)
+				for index in run:
+					del self._pages[index]
+				run = []
+
+	def create(self):
+		"""Replaces the blob with an empty page blob right away."""
+		with self._lock:
+			self._updated(self.services.page.create_blob(self.container, self.blob, 0))
+			self.size = self._blob_size = 0
+			self._pages.clear()
+			self.changed = False
+
+	def write(self, data, offset):
+		data = memoryview(data)
+		end = offset + len(data)
+		with self._lock:
+			position = offset
+			while position < end:
+				index = position // self.page_size
+				start = index * self.page_size
+				low, high = position - start, min(end - start, self.page_size)
+				chunk = data[position - offset:position - offset + high - low]
+				if high - low == self.page_size:
+					self._pages[index] = bytearray(chunk.tobytes())
+				else:
+					self._page(index)[low:high] = chunk
+				position = start + high
+			self.size = max(self.size, self._round(end))
+			self.changed = True
+			if self.dirty_bytes >= self.max_dirty:
+				self._write_pages()
+		return len(data)
+
+	def truncate(self, length):
+		with self._lock:
+			size = self._round(length)
+			for index in [index for index in self._pages if index * self.page_size >= size]:
+				del self._pages[index]
+			if length % self.page_size and length < self.size:
+				# the rest of the last page reads as zeros, as it would in a file
+				page = self._page(length // self.page_size)
+				page[length % self.page_size:] = bytearray(self.page_size - length % self.page_size)
+			if size < self._blob_size:
+				self._resize(size)
+			self.size = size
+			self.changed = True
+
+	def flush(self):
+		"""
+		Resizes the blob and writes the pending pages. Returns True if
+		anything had changed.
+		"""
+		with self._lock:
+			if not self.changed:
+				return False
+			self._write_pages()
+			self.changed = False
+			return True